@@ -1,19 +1,30 @@
-from fastapi import FastAPI, UploadFile, File, Query, HTTPException
+from fastapi import FastAPI, UploadFile, File, Query, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.responses import Response, JSONResponse
 from fastapi import Body
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, ValidationError
 from PIL import Image
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, Union, BinaryIO
+import asyncio
+import hashlib
 import io
+import json
 import shutil
 import subprocess
-import tempfile
 import os
 import sys
 import math
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import combinations, repeat
+import numpy as np
 try:
-    from pyembroidery import EmbPattern, read, STITCH, JUMP, TRIM, COLOR_CHANGE, STOP, END
+    from pyembroidery import EmbPattern, STITCH, JUMP, TRIM, COLOR_CHANGE, STOP, END
     _HAS_PYEMBROIDERY = True
 except Exception:
     _HAS_PYEMBROIDERY = False
@@ -22,19 +33,55 @@ try:
     _HAS_SVGPATHTOOLS = True
 except Exception:
     _HAS_SVGPATHTOOLS = False
+try:
+    from numba import njit
+    _HAS_NUMBA = True
+except Exception:
+    _HAS_NUMBA = False
+try:
+    from scipy.spatial import cKDTree
+    from scipy.spatial.distance import pdist
+    _HAS_SCIPY = True
+except Exception:
+    _HAS_SCIPY = False
+try:
+    import cv2
+    _HAS_CV2 = True
+except Exception:
+    _HAS_CV2 = False
+try:
+    import pyvips
+    _HAS_PYVIPS = True
+except Exception:
+    _HAS_PYVIPS = False
+try:
+    import orjson  # noqa: F401  (enables ORJSONResponse)
+    from fastapi.responses import ORJSONResponse
+    _HAS_ORJSON = True
+except Exception:
+    _HAS_ORJSON = False
 
-class GenerateFromPointsReq(BaseModel):
-    """Request payload for /embroidery/generate_from_points."""
-    # points in PIXEL space, relative to a canvas of given width/height
-    points: List[Dict[str, float]]
+# Stitch plans are large numeric payloads; orjson encodes them (and NumPy arrays) natively,
+# so it is also the app-wide default for every JSON response
+FastJSONResponse = ORJSONResponse if _HAS_ORJSON else JSONResponse
+json_loads = orjson.loads if _HAS_ORJSON else json.loads
+
+class GenerateFromPointsParams(BaseModel):
+    """Scalar parameters of /embroidery/generate_from_points (everything but the points)."""
     canvas_width: int
     canvas_height: int
     strategy: str = "outline"
-    density: float = 1.0
-    width_mm: float = 2.0
-    passes: int = 1
+    density: float = Field(1.0, gt=0, le=100)
+    width_mm: float = Field(2.0, gt=0, le=100)
+    passes: int = Field(1, ge=1, le=100)
     stitch_len_mm: float = 2.5
     mm_per_px: float = 0.26
+    layout: str = "points"
+
+class GenerateFromPointsReq(GenerateFromPointsParams):
+    """Request payload for /embroidery/generate_from_points."""
+    # points in PIXEL space, relative to a canvas of given width/height
+    points: List[Dict[str, float]]
 
 class AIDesignReq(BaseModel):
     """Request payload for AI design generation."""
@@ -63,7 +110,7 @@ class CollaborationReq(BaseModel):
     action: str
     data: Dict[str, Any]
 
-app = FastAPI(title="Closset AI Service")
+app = FastAPI(title="Closset AI Service", default_response_class=FastJSONResponse)
 
 # CORS for local dev and web app
 app.add_middleware(
@@ -74,6 +121,24 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Upper bound on points in any generated plan; tiny spacings on long paths would otherwise
+# allocate without limit
+MAX_STITCHES = 1_000_000
+
+class StitchLimitError(ValueError):
+    """Raised when a requested plan would exceed MAX_STITCHES."""
+
+def _check_stitch_budget(n: float, limit: float = MAX_STITCHES) -> None:
+    """Reject a plan (HTTP 400 via the handler below) once its size estimate passes the limit
+    (MAX_STITCHES, or what is left of it for one part of a larger plan)."""
+    if n > limit:
+        raise StitchLimitError(f"stitch density too high (plan would exceed {MAX_STITCHES} stitches)")
+
+@app.exception_handler(StitchLimitError)
+async def _stitch_limit_handler(request: Request, exc: StitchLimitError):
+    """Report oversized plans as a client error rather than a 500."""
+    return FastJSONResponse({"detail": str(exc)}, status_code=400)
+
 def _which(cmd: str) -> str:
     """Return full path if executable is available in PATH, else empty string."""
     from shutil import which
@@ -91,10 +156,15 @@ def detect_inkscape() -> Dict[str, Any]:
             version = None
     return {"found": bool(exe), "path": exe, "version": version}
 
-def stitch_flags_to_str(flags: int) -> str:
-    """Map pyembroidery stitch flags to readable type."""
-    if not _HAS_PYEMBROIDERY:
-        return "stitch"
+def _build_flag_lut() -> Tuple[str, ...]:
+    """Readable stitch type for every value of the low command byte.
+
+    pyembroidery commands are enumerated in the low byte, not independent bits.
+    """
+    names = {JUMP: "jump", TRIM: "trim", COLOR_CHANGE: "color_change", STOP: "stop", END: "end"} if _HAS_PYEMBROIDERY else {}
+    return tuple(names.get(f, "stitch") for f in range(256))
+
+_FLAG_LUT = _build_flag_lut()
 
 def _parse_color(s: Optional[str]) -> str:
     if not s:
@@ -103,190 +173,635 @@ def _parse_color(s: Optional[str]) -> str:
     # Simple pass-through for hex and rgb(a)
     return s
 
-def svg_to_stitches(svg_bytes: bytes, *,
+# Stitch type codes for the structure-of-arrays (SoA) plan layout
+STITCH_TYPE_NAMES = ("stitch", "jump", "trim", "color_change", "stop", "end")
+PLAN_LAYOUTS = ("points", "soa")
+# Stitch type code for every value of the low command byte (see _FLAG_LUT)
+_FLAG_CODE_LUT = np.array([STITCH_TYPE_NAMES.index(name) for name in _FLAG_LUT], dtype=np.uint8)
+
+def expand_points(plan: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Expand an SoA plan into the legacy [{x, y, type[, color]}] point list."""
+    xs = np.asarray(plan["xs"]).tolist()
+    ys = np.asarray(plan["ys"]).tolist()
+    names = [STITCH_TYPE_NAMES[t] for t in np.asarray(plan["types"]).tolist()]
+    points: List[Dict[str, Any]] = []
+    prev = 0
+    for cc in plan.get("color_changes", []):
+        at = cc["at"]
+        points.extend({"x": x, "y": y, "type": t} for x, y, t in zip(xs[prev:at], ys[prev:at], names[prev:at]))
+        points.append({"x": xs[at], "y": ys[at], "type": "color_change", "color": cc["color"]})
+        prev = at
+    points.extend({"x": x, "y": y, "type": t} for x, y, t in zip(xs[prev:], ys[prev:], names[prev:]))
+    return points
+
+def _json_array(a) -> Any:
+    """Hand NumPy arrays straight to orjson; fall back to lists for stdlib json."""
+    if _HAS_ORJSON:
+        return np.ascontiguousarray(a, dtype=np.float64)
+    return np.asarray(a).tolist()
+
+def plan_payload(plan: Dict[str, Any], layout: str = "points") -> Dict[str, Any]:
+    """Materialize an internal SoA plan as JSON in the requested layout."""
+    if layout not in PLAN_LAYOUTS:
+        raise HTTPException(status_code=400, detail=f"layout must be one of {', '.join(PLAN_LAYOUTS)}")
+    if layout == "points":
+        return {"ok": True, "points": expand_points(plan), "info": plan["info"]}
+    return {
+        "ok": True,
+        "xs": _json_array(plan["xs"]),
+        "ys": _json_array(plan["ys"]),
+        "types": [STITCH_TYPE_NAMES[t] for t in np.asarray(plan["types"]).tolist()],
+        "color_changes": plan.get("color_changes", []),
+        "info": plan["info"],
+    }
+
+def _eval_segment(fn, ts: np.ndarray) -> np.ndarray:
+    """Evaluate a segment's point() over an array of t values."""
+    try:
+        out = np.asarray(fn(ts), dtype=complex)
+    except (TypeError, ValueError):
+        # svgpathtools releases without array-aware evaluation
+        out = np.array([fn(float(t)) for t in ts], dtype=complex)
+    return np.broadcast_to(out, ts.shape)
+
+def _bernstein(ts: np.ndarray, degree: int) -> np.ndarray:
+    """Bernstein basis matrix of shape (len(ts), degree + 1)."""
+    k = np.arange(degree + 1)
+    coeff = np.array([math.comb(degree, i) for i in k], dtype=np.float64)
+    return coeff * (1.0 - ts)[:, None] ** (degree - k) * ts[:, None] ** k
+
+def unit_tangents(P: np.ndarray) -> np.ndarray:
+    """Unit tangents of an (N, 2) point run by finite differences (one-sided at the ends)."""
+    if len(P) < 2:
+        return np.zeros_like(P)
+    T = np.gradient(P, axis=0)
+    T /= np.maximum(np.hypot(T[:, 0], T[:, 1]), 1e-9)[:, None]
+    return T
+
+# Dense arc-length table sizes; their t grids and Bernstein bases are built once at import
+_DENSE_SIZES = (16, 32, 64, 128, 256, 512)
+_DENSE_TS = {n: np.linspace(0.0, 1.0, n + 1) for n in _DENSE_SIZES}
+_BERNSTEIN_CACHE = {(n, d): _bernstein(_DENSE_TS[n], d) for n in _DENSE_SIZES for d in (1, 2, 3)}
+
+def _segment_dense(seg, want: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Evaluate a segment on the smallest cached t grid with at least `want` intervals."""
+    n = next((size for size in _DENSE_SIZES if size >= want), _DENSE_SIZES[-1])
+    ts = _DENSE_TS[n]
+    if hasattr(seg, "bpoints"):
+        bpts = np.asarray(seg.bpoints(), dtype=complex)
+        return ts, _BERNSTEIN_CACHE[(n, len(bpts) - 1)] @ bpts
+    return ts, _eval_segment(seg.point, ts)
+
+def segment_lengths(path: "SvgPath") -> List[float]:
+    """Arc length of each segment; computed once per path and reused by samplers."""
+    return [seg.length(error=1e-3) for seg in path]
+
+# Coarse inscribed polyline for stitch-count lower bounds (see _path_stitch_floor)
+_FLOOR_TS = np.linspace(0.0, 1.0, 5)
+_FLOOR_BASES = {d: _bernstein(_FLOOR_TS, d) for d in (1, 2, 3)}
+
+def _path_stitch_floor(path: "SvgPath", spacing: float) -> float:
+    """Lower bound on a path's sample count, far cheaper than its arc length.
+
+    A polyline inscribed in a curve is never longer than the curve, and the sampler
+    emits at least one point per spacing of length.
+    """
+    length = 0.0
+    for seg in path:
+        if hasattr(seg, "bpoints"):
+            z = _FLOOR_BASES[len(seg.bpoints()) - 1] @ np.asarray(seg.bpoints(), dtype=complex)
+        else:
+            z = _eval_segment(seg.point, _FLOOR_TS)
+        length += float(np.abs(np.diff(z)).sum())
+    return length / max(0.5, spacing)
+
+def _segment_eval(seg, ts: np.ndarray) -> np.ndarray:
+    """Evaluate one path segment at an array of t values."""
+    if hasattr(seg, "bpoints"):
+        # Line/QuadraticBezier/CubicBezier: skip svgpathtools dispatch entirely
+        bpts = np.asarray(seg.bpoints(), dtype=complex)
+        return _bernstein(ts, len(bpts) - 1) @ bpts
+    return _eval_segment(seg.point, ts)
+
+def _sample_path_array(path: "SvgPath", spacing: float, with_tangents: bool = False,
+                       seg_lengths: Optional[List[float]] = None) -> np.ndarray:
+    """Sample an SVG path at uniform arc length; columns are x, y (and tx, ty).
+
+    Each segment gets a dense arc-length table that is inverted with np.interp,
+    so spacing stays even on tight curves instead of following the t parameter.
+    Tangents are finite differences over each continuous run of samples, which
+    is plenty for normals and avoids evaluating the analytic derivative.
+    """
+    spacing = max(0.5, spacing)
+    if seg_lengths is None:
+        seg_lengths = segment_lengths(path)
+    _check_stitch_budget(sum(seg_lengths) / spacing)
+    segs = list(path)
+    if _HAS_NUMBA and segs and all(hasattr(seg, "bpoints") for seg in segs):
+        return _sample_beziers(segs, seg_lengths, spacing, with_tangents)
+    blocks: List[np.ndarray] = []
+    run: List[np.ndarray] = []
+    carry = 0.0  # arc length travelled since the last emitted sample
+    for i, (seg, seg_len) in enumerate(zip(segs, seg_lengths)):
+        continuous = i > 0 and seg.start == segs[i - 1].end
+        closes_run = i + 1 == len(segs) or segs[i + 1].start != seg.end
+        ts_dense, z_dense = _segment_dense(seg, 8 * seg_len / spacing)
+        if seg_len > 0:
+            cum = np.concatenate(([0.0], np.cumsum(np.abs(np.diff(z_dense)))))
+        else:
+            # zero-length segment: pin the table at 0 rather than trusting evaluation round-off
+            cum = np.zeros(len(ts_dense))
+        if continuous:
+            targets = np.arange(spacing - carry, cum[-1], spacing)
+        else:
+            # a new subpath always emits its start point, even for degenerate segments
+            targets = np.arange(0.0, max(cum[-1], 1e-9), spacing)
+        carry = (cum[-1] - targets[-1]) if len(targets) else carry + cum[-1]
+        ts = np.interp(targets, cum, ts_dense)
+        if closes_run and (not len(ts) or ts[-1] < 1.0):
+            ts = np.append(ts, 1.0)
+            carry = 0.0
+        if len(ts):
+            z = _segment_eval(seg, ts)
+            run.append(np.column_stack((z.real, z.imag)))
+        if closes_run and run:
+            P = np.concatenate(run)
+            blocks.append(np.hstack((P, unit_tangents(P))) if with_tangents else P)
+            run = []
+    if not blocks:
+        return np.empty((0, 4 if with_tangents else 2))
+    return np.concatenate(blocks)
+
+def _cubic_controls(segs: list) -> np.ndarray:
+    """(m, 4) complex cubic control points; lines and quadratics are degree-elevated exactly."""
+    ctrl = np.empty((len(segs), 4), dtype=complex)
+    for i, seg in enumerate(segs):
+        b = seg.bpoints()
+        if len(b) == 4:
+            ctrl[i] = b
+        elif len(b) == 3:
+            ctrl[i] = (b[0], b[0] + 2.0 / 3.0 * (b[1] - b[0]), b[2] + 2.0 / 3.0 * (b[1] - b[2]), b[2])
+        else:
+            ctrl[i] = (b[0], b[0] + (b[1] - b[0]) / 3.0, b[0] + 2.0 * (b[1] - b[0]) / 3.0, b[1])
+    return ctrl
+
+if _HAS_NUMBA:
+    @njit(cache=True)
+    def _cubic_at(cx, cy, i, t):
+        mt = 1.0 - t
+        a, b, c, d = mt * mt * mt, 3.0 * mt * mt * t, 3.0 * mt * t * t, t * t * t
+        return (a * cx[i, 0] + b * cx[i, 1] + c * cx[i, 2] + d * cx[i, 3],
+                a * cy[i, 0] + b * cy[i, 1] + c * cy[i, 2] + d * cy[i, 3])
+
+    @njit(cache=True)
+    def _run_tangents(ox, oy, tx, ty, lo, hi):
+        """np.gradient-style unit tangents for samples lo..hi-1 (one continuous run)."""
+        if hi - lo < 2:
+            for i in range(lo, hi):
+                tx[i] = 0.0
+                ty[i] = 0.0
+            return
+        for i in range(lo, hi):
+            if i == lo:
+                dx, dy = ox[i + 1] - ox[i], oy[i + 1] - oy[i]
+            elif i == hi - 1:
+                dx, dy = ox[i] - ox[i - 1], oy[i] - oy[i - 1]
+            else:
+                dx, dy = (ox[i + 1] - ox[i - 1]) / 2.0, (oy[i + 1] - oy[i - 1]) / 2.0
+            mag = max(math.hypot(dx, dy), 1e-9)
+            tx[i] = dx / mag
+            ty[i] = dy / mag
+
+    @njit(cache=True)
+    def _sample_beziers_jit(cx, cy, dense_n, degenerate, continuous, closes_run, spacing, cap):
+        """Compiled twin of the _sample_path_array loop over cubic segments; returns x, y, tx, ty."""
+        ox = np.empty(cap)
+        oy = np.empty(cap)
+        k = 0
+        run_start = 0
+        carry = 0.0
+        tx = np.empty(cap)
+        ty = np.empty(cap)
+        for i in range(cx.shape[0]):
+            n = dense_n[i]
+            step = 1.0 / n
+            cum = np.empty(n + 1)
+            cum[0] = 0.0
+            if degenerate[i]:
+                # zero-length segment: a flat table, exactly as the NumPy loop pins it
+                cum[:] = 0.0
+            else:
+                px, py = _cubic_at(cx, cy, i, 0.0)
+                for j in range(1, n + 1):
+                    qx, qy = _cubic_at(cx, cy, i, 1.0 if j == n else j * step)
+                    cum[j] = cum[j - 1] + math.hypot(qx - px, qy - py)
+                    px, py = qx, qy
+            seg_len = cum[n]
+            if continuous[i]:
+                start, stop = spacing - carry, seg_len
+            else:
+                # a new subpath always emits its start point, even for degenerate segments
+                start, stop = 0.0, max(seg_len, 1e-9)
+            cnt = max(0, int(math.ceil((stop - start) / spacing)))
+            carry = (seg_len - (start + (cnt - 1) * spacing)) if cnt > 0 else carry + seg_len
+            if k + cnt + 1 > cap:
+                cap = max(2 * cap, k + cnt + 1)
+                grown = np.empty((4, cap))
+                grown[0, :k] = ox[:k]
+                grown[1, :k] = oy[:k]
+                grown[2, :k] = tx[:k]
+                grown[3, :k] = ty[:k]
+                ox, oy, tx, ty = grown[0], grown[1], grown[2], grown[3]
+            # invert the arc-length table like np.interp(targets, cum, linspace(0, 1, n + 1))
+            j = 0
+            t = 0.0
+            for q in range(cnt):
+                x = start + q * spacing
+                if x >= seg_len:
+                    t = 1.0
+                elif x <= 0.0:
+                    t = 0.0
+                else:
+                    while cum[j + 1] <= x:
+                        j += 1
+                    t = step * j + (x - cum[j]) * step / (cum[j + 1] - cum[j])
+                ox[k], oy[k] = _cubic_at(cx, cy, i, t)
+                k += 1
+            if closes_run[i]:
+                if cnt == 0 or t < 1.0:
+                    ox[k], oy[k] = _cubic_at(cx, cy, i, 1.0)
+                    k += 1
+                    carry = 0.0
+                _run_tangents(ox, oy, tx, ty, run_start, k)
+                run_start = k
+        return ox[:k], oy[:k], tx[:k], ty[:k]
+
+def _sample_beziers(segs: list, seg_lengths: List[float], spacing: float, with_tangents: bool) -> np.ndarray:
+    """Compiled path of _sample_path_array for paths made only of Bezier segments."""
+    ctrl = _cubic_controls(segs)
+    starts, ends = ctrl[:, 0], ctrl[:, 3]
+    continuous = np.zeros(len(segs), dtype=np.bool_)
+    continuous[1:] = starts[1:] == ends[:-1]
+    closes_run = np.ones(len(segs), dtype=np.bool_)
+    closes_run[:-1] = starts[1:] != ends[:-1]
+    sizes = np.array(_DENSE_SIZES)
+    want = 8.0 * np.asarray(seg_lengths, dtype=np.float64) / spacing
+    degenerate = want <= 0  # same zero-length test as the NumPy loop
+    dense_n = sizes[np.minimum(np.searchsorted(sizes, want), len(sizes) - 1)]
+    # chord tables never exceed the true length, so this rarely has to grow
+    cap = int(sum(seg_lengths) / spacing * 1.01) + 2 * len(segs) + 16
+    xs, ys, txs, tys = _sample_beziers_jit(np.ascontiguousarray(ctrl.real), np.ascontiguousarray(ctrl.imag),
+                                           dense_n, degenerate, continuous, closes_run, float(spacing), cap)
+    return np.column_stack((xs, ys, txs, tys) if with_tangents else (xs, ys))
+
+def _as_stream(src: Union[bytes, BinaryIO]) -> BinaryIO:
+    """Binary stream over an upload given as bytes or as a (spooled) file object, rewound to the start."""
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        return io.BytesIO(src)
+    src.seek(0)
+    return src
+
+def _content_digest(src: Union[bytes, BinaryIO]) -> bytes:
+    """blake2b-128 of an upload, hashing file objects in chunks instead of loading them whole."""
+    h = hashlib.blake2b(digest_size=16)
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        h.update(src)
+    else:
+        stream = _as_stream(src)
+        for chunk in iter(lambda: stream.read(1 << 20), b""):
+            h.update(chunk)
+    return h.digest()
+
+# LRU of built SVG plans keyed by (content hash, generation params)
+_SVG_PLAN_CACHE: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+_SVG_PLAN_CACHE_SIZE = 64
+_SVG_PLAN_CACHE_LOCK = threading.Lock()
+
+def svg_to_stitches(svg_src: Union[bytes, BinaryIO], *,
                     mm_per_px: float = 0.26,
                     stitch_len_mm: float = 2.5,
                     strategy: str = "outline",
                     density: float = 1.0,
                     width_mm: float = 2.0,
-                    passes: int = 1) -> Dict[str, Any]:
-    """Convert SVG into a stitch plan.
+                    passes: int = 1,
+                    layout: str = "points") -> Dict[str, Any]:
+    """Convert SVG (bytes or an upload's file object) into a stitch plan.
 
     strategy: 'outline' (sample along path), 'satin' (parallel outline; basic), 'fill' (basic hatch fill placeholder)
     density: multiplier for stitch density (1.0 = base)
+    layout: 'points' (list of {x, y, type}) or 'soa' (parallel xs/ys/types arrays + color_changes)
     """
     if not _HAS_SVGPATHTOOLS:
         raise HTTPException(status_code=501, detail="svgpathtools not installed on the server")
 
-    with tempfile.NamedTemporaryFile(suffix=".svg", delete=False) as tmp:
-        tmp.write(svg_bytes)
-        tmp.flush()
-        svg_path = tmp.name
-    try:
-        paths, attrs, svg_attr = svg2paths2(svg_path)
-        stitch_len_px = (stitch_len_mm / mm_per_px if mm_per_px > 0 else stitch_len_mm) / max(0.25, density)
-        width_px = (width_mm / mm_per_px if mm_per_px > 0 else width_mm)
-        points: List[Dict[str, Any]] = []
-        layers: List[Dict[str, Any]] = []
+    # Clients re-request the same SVG/params on preview toggles; reuse the plan by content hash
+    key = (_content_digest(svg_src),
+           mm_per_px, stitch_len_mm, strategy, density, width_mm, passes)
+    with _SVG_PLAN_CACHE_LOCK:
+        plan = _SVG_PLAN_CACHE.get(key)
+        if plan is not None:
+            _SVG_PLAN_CACHE.move_to_end(key)
+    if plan is None:
+        plan = _svg_plan(svg_src, mm_per_px=mm_per_px, stitch_len_mm=stitch_len_mm, strategy=strategy,
+                         density=density, width_mm=width_mm, passes=passes)
+        with _SVG_PLAN_CACHE_LOCK:
+            _SVG_PLAN_CACHE[key] = plan
+            while len(_SVG_PLAN_CACHE) > _SVG_PLAN_CACHE_SIZE:
+                _SVG_PLAN_CACHE.popitem(last=False)
+    return plan_payload(plan, layout)
+
+def _offsets_per_point(strategy: str, stitch_len_px: float, width_px: float, passes: int) -> int:
+    """Stitches normal_offsets puts around each resampled point (1 for the centerline)."""
+    k = normal_offsets(strategy, 1, width_px, stitch_len_px, passes)
+    return 1 if k is None else k.shape[1]
+
+def _stitches_per_point(strategy: str, stitch_len_px: float, width_px: float, passes: int) -> int:
+    """Stitches _path_stitches emits per sample along the path."""
+    if strategy not in ("satin", "fill"):
+        return 1
+    return _offsets_per_point(strategy, stitch_len_px, width_px, passes)
+
+def _path_stitches(p: "SvgPath", strategy: str, stitch_len_px: float, width_px: float,
+                   passes: int, allowance: float = MAX_STITCHES) -> Tuple[np.ndarray, np.ndarray]:
+    """Stitch coordinates for a single SVG path (module-level so worker processes can run it).
+
+    `allowance` is the share of MAX_STITCHES this path may use; it is checked before
+    any sampling is done.
+    """
+    # Segment lengths are the expensive part of SVG evaluation; integrate once per path
+    seg_lens = segment_lengths(p)
+    if sum(seg_lens) <= 0:
+        return np.empty(0), np.empty(0)
+    per_point = _stitches_per_point(strategy, stitch_len_px, width_px, passes)
+    _check_stitch_budget(sum(seg_lens) / max(0.5, stitch_len_px) * per_point, allowance)
+    if strategy in ("satin", "fill"):
+        # Basic satin zig-zags across the path normals; fill sweeps a small row of bands
+        base = _sample_path_array(p, stitch_len_px, with_tangents=True, seg_lengths=seg_lens)
+        bx, by, tx, ty = base.T
+        k = normal_offsets(strategy, len(base), width_px, stitch_len_px, passes)
+        return expand_along_normals(bx, by, tx, ty, k)
+    base = _sample_path_array(p, stitch_len_px, seg_lengths=seg_lens)
+    return base[:, 0], base[:, 1]
+
+# SVGs with at least this many paths are sampled in a process pool
+_SVG_PARALLEL_MIN_PATHS = 64
+_SVG_POOL: Optional[ProcessPoolExecutor] = None
+_SVG_POOL_LOCK = threading.Lock()
+
+def _svg_pool() -> Optional[ProcessPoolExecutor]:
+    """Shared worker pool for large SVGs, created on first use; None on single-core hosts."""
+    global _SVG_POOL
+    if (os.cpu_count() or 1) < 2:
+        return None
+    with _SVG_POOL_LOCK:
+        if _SVG_POOL is None:
+            _SVG_POOL = ProcessPoolExecutor(max_workers=os.cpu_count())
+        return _SVG_POOL
+
+def _svg_plan(svg_src: Union[bytes, BinaryIO], *, mm_per_px: float, stitch_len_mm: float, strategy: str,
+              density: float, width_mm: float, passes: int) -> Dict[str, Any]:
+    """Build the internal SoA plan for an SVG (uncached; see svg_to_stitches)."""
+    # svgpathtools parses file-like objects directly, so no temp file is needed
+    paths, attrs, svg_attr = svg2paths2(_as_stream(svg_src))
+    stitch_len_px = (stitch_len_mm / mm_per_px if mm_per_px > 0 else stitch_len_mm) / max(0.25, density)
+    width_px = (width_mm / mm_per_px if mm_per_px > 0 else width_mm)
+    xs_parts: List[np.ndarray] = []
+    ys_parts: List[np.ndarray] = []
+    color_changes: List[Dict[str, Any]] = []
+    layers: List[Dict[str, Any]] = []
+    total = 0
+
+    # Every path yields at least its floor, so an oversized plan is rejected before any
+    # sampling, and each path may only use what the other paths' floors leave over
+    per_point = _stitches_per_point(strategy, stitch_len_px, width_px, passes)
+    floors = np.array([_path_stitch_floor(p, stitch_len_px) for p in paths]) * per_point
+    _check_stitch_budget(floors.sum())
+    allowances = (MAX_STITCHES - (floors.sum() - floors)).tolist()
+
+    pool = _svg_pool() if len(paths) >= _SVG_PARALLEL_MIN_PATHS else None
+    if pool is not None:
+        # Paths are independent; fan them out across processes, preserving order
+        chunk = max(1, len(paths) // (4 * (os.cpu_count() or 1)))
+        results = pool.map(_path_stitches, paths, repeat(strategy), repeat(stitch_len_px),
+                           repeat(width_px), repeat(passes), allowances, chunksize=chunk)
+    else:
+        results = (_path_stitches(p, strategy, stitch_len_px, width_px, passes, allowance)
+                   for p, allowance in zip(paths, allowances))
 
-        for i, p in enumerate(paths):
+    try:
+        for i, (lx, ly) in enumerate(results):
             a = attrs[i] if i < len(attrs) else {}
             stroke = _parse_color(a.get('stroke'))
             fill = _parse_color(a.get('fill')) if a.get('fill') not in (None, 'none') else None
-            length = p.length(error=1e-3)
-            if length <= 0:
-                continue
-
-            def sample_path(path: SvgPath, spacing: float) -> List[Dict[str, Any]]:
-                n = max(1, int(path.length(error=1e-3) // max(0.5, spacing)))
-                pts: List[Dict[str, Any]] = []
-                for k in range(n + 1):
-                    t = k / max(1, n)
-                    z = path.point(t)
-                    pts.append({"x": float(z.real), "y": float(z.imag), "type": "stitch"})
-                return pts
-
-            def sample_path_with_derivs(path: SvgPath, spacing: float) -> List[Dict[str, Any]]:
-                n = max(1, int(path.length(error=1e-3) // max(0.5, spacing)))
-                pts: List[Dict[str, Any]] = []
-                for k in range(n + 1):
-                    t = k / max(1, n)
-                    z = path.point(t)
-                    dz = path.derivative(t)
-                    pts.append({
-                        "x": float(z.real),
-                        "y": float(z.imag),
-                        "dx": float(dz.real),
-                        "dy": float(dz.imag),
-                        "type": "stitch"
-                    })
-                return pts
-
             layer_color = stroke or (fill or "#000000")
-            layer_pts: List[Dict[str, Any]] = []
-
-            if strategy == "outline":
-                layer_pts = sample_path(p, stitch_len_px)
-            elif strategy == "satin":
-                # Basic satin: create zig-zag across path normals with given width and passes
-                base = sample_path_with_derivs(p, stitch_len_px)
-                gg: List[Dict[str, Any]] = []
-                side = 1.0
-                for b in base:
-                    # normal = (-dy, dx) normalized
-                    dx, dy = b.get("dx", 0.0), b.get("dy", 0.0)
-                    mag = (dx*dx + dy*dy) ** 0.5 or 1.0
-                    nx, ny = -dy / mag, dx / mag
-                    # multiple passes reduce spacing between zig lines slightly
-                    w = width_px
-                    for pp in range(max(1, passes)):
-                        off = (w * (1.0 - (pp / max(1, passes)))) * 0.5
-                        gg.append({"x": b["x"] + side * off * nx, "y": b["y"] + side * off * ny, "type": "stitch"})
-                    side *= -1.0
-                layer_pts = gg
-            elif strategy == "fill":
-                # Simple banded fill along path direction: step along path and sweep small spans across normal
-                base = sample_path_with_derivs(p, stitch_len_px)
-                ff: List[Dict[str, Any]] = []
-                bands = max(1, int(max(2.0, width_px) // max(1.0, stitch_len_px)))
-                for b in base:
-                    dx, dy = b.get("dx", 0.0), b.get("dy", 0.0)
-                    mag = (dx*dx + dy*dy) ** 0.5 or 1.0
-                    nx, ny = -dy / mag, dx / mag
-                    # create a small row of stitches across width
-                    for bi in range(-bands, bands + 1):
-                        off = (bi / max(1, bands)) * (width_px * 0.5)
-                        ff.append({"x": b["x"] + off * nx, "y": b["y"] + off * ny, "type": "stitch"})
-                layer_pts = ff
-            else:
-                layer_pts = sample_path(p, stitch_len_px)
-
-            # Attach color to first point of layer as a color_change marker
-            if layer_pts:
-                points.append({"x": layer_pts[0]["x"], "y": layer_pts[0]["y"], "type": "color_change", "color": layer_color})
-                points.extend(layer_pts)
-                layers.append({"index": i, "count": len(layer_pts), "color": layer_color})
-
-        info = {
-            "stitch_count": len([p for p in points if p.get("type") == "stitch"]),
-            "layers": layers,
-            "strategy": strategy,
-            "mm_per_px": mm_per_px,
-            "stitch_len_mm": stitch_len_mm,
-            "width_mm": width_mm,
-            "passes": passes,
-        }
-        return {"ok": True, "points": points, "info": info}
+
+            # Each layer starts with a color change at its first point
+            if len(lx):
+                _check_stitch_budget(total + len(lx))
+                color_changes.append({"at": total, "color": layer_color})
+                layers.append({"index": i, "start_index": total, "count": len(lx), "color": layer_color})
+                xs_parts.append(lx)
+                ys_parts.append(ly)
+                total += len(lx)
     finally:
-        try:
-            os.remove(svg_path)
-        except Exception:
-            pass
+        # On a budget error, cancel the pool work that has not started yet
+        results.close()
 
-def running_stitches_to_dst(points: List[Dict[str, Any]]) -> bytes:
+    info = {
+        "stitch_count": total,
+        "layers": layers,
+        "strategy": strategy,
+        "mm_per_px": mm_per_px,
+        "stitch_len_mm": stitch_len_mm,
+        "width_mm": width_mm,
+        "passes": passes,
+    }
+    plan = {
+        "xs": np.concatenate(xs_parts) if xs_parts else np.empty(0),
+        "ys": np.concatenate(ys_parts) if ys_parts else np.empty(0),
+        "types": np.zeros(total, dtype=np.uint8),
+        "color_changes": color_changes,
+        "info": info,
+    }
+    return plan
+
+def plan_to_dst(plan: Dict[str, Any]) -> bytes:
+    """Encode an SoA plan as DST, emitting COLOR_CHANGE inline at each color_changes index."""
     if not _HAS_PYEMBROIDERY:
         raise HTTPException(status_code=501, detail="pyembroidery not installed on the server")
-    pattern = EmbPattern()
+    coords = np.column_stack((np.asarray(plan["xs"], dtype=np.float64), np.asarray(plan["ys"], dtype=np.float64)))
+    if not len(coords):
+        return b""
     # Normalize to start at origin
+    coords -= coords[0]
+    # A change before the first stitch would only add an empty color block
+    breaks = sorted({cc["at"] for cc in plan.get("color_changes", []) if 0 < cc["at"] < len(coords)})
+    pattern = EmbPattern()
+    # Fill the stitch list in one go rather than one add_stitch_absolute() call per point
+    stitches: List[List[float]] = []
+    prev = 0
+    for at in breaks + [len(coords)]:
+        stitches.extend([x, y, STITCH] for x, y in coords[prev:at].tolist())
+        if at < len(coords):
+            stitches.append([coords[at, 0], coords[at, 1], COLOR_CHANGE])
+        prev = at
+    pattern.stitches = stitches
+    pattern.end()
+    # lazy import to ensure symbol exists; DST is a plain stream format, so write straight to memory
+    from pyembroidery import write_dst
+    buf = io.BytesIO()
+    write_dst(pattern, buf)
+    return buf.getvalue()
+
+def running_stitches_to_dst(points: List[Dict[str, Any]]) -> bytes:
+    """Encode legacy [{x, y, type}] points as DST; color_change markers become machine color changes."""
     if not points:
         return b""
-    x0 = points[0]["x"]; y0 = points[0]["y"]
-    for i, pt in enumerate(points):
-        x = float(pt["x"]) - x0
-        y = float(pt["y"]) - y0
-        pattern.add_stitch_absolute(x, y, STITCH)
-    pattern.end()
-    with tempfile.NamedTemporaryFile(suffix=".dst", delete=False) as tmp:
-        tmp_path = tmp.name
-    try:
-        # lazy import to ensure symbol exists
-        from pyembroidery import write
-        write(pattern, tmp_path)
-        with open(tmp_path, "rb") as f:
-            return f.read()
-    finally:
-        try:
-            os.remove(tmp_path)
-        except Exception:
-            pass
-    if flags & JUMP:
-        return "jump"
-    if flags & TRIM:
-        return "trim"
-    if flags & COLOR_CHANGE:
-        return "color_change"
-    if flags & STOP:
-        return "stop"
-    if flags & END:
-        return "end"
-    return "stitch"
-
-def parse_machine_file_to_plan(data: bytes, fmt_hint: str = "dst") -> Dict[str, Any]:
+    # Markers sit on the first point of the next layer, so they carry position only
+    # as metadata and are folded into the following stitch instead of duplicating it
+    coords = [(pt["x"], pt["y"]) for pt in points if pt.get("type") != "color_change"]
+    color_changes: List[Dict[str, Any]] = []
+    n = 0
+    for pt in points:
+        if pt.get("type") == "color_change":
+            color_changes.append({"at": n, "color": pt.get("color")})
+        else:
+            n += 1
+    xy = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    return plan_to_dst({"xs": xy[:, 0], "ys": xy[:, 1], "color_changes": color_changes})
+
+def _machine_reader(fmt: str):
+    """pyembroidery reader module for a file extension, or None if unsupported."""
+    for file_type in EmbPattern.supported_formats():
+        if file_type["extension"] == fmt and file_type.get("reader") is not None:
+            return file_type["reader"]
+    return None
+
+def parse_machine_file_to_plan(data: Union[bytes, BinaryIO], fmt_hint: str = "dst", layout: str = "points") -> Dict[str, Any]:
     """Parse an uploaded machine file (e.g., DST/PES) into a JSON stitch plan."""
     if not _HAS_PYEMBROIDERY:
         raise HTTPException(status_code=501, detail="pyembroidery not installed on the server")
-    with tempfile.NamedTemporaryFile(suffix=f".{fmt_hint}", delete=False) as tmp:
-        tmp.write(data)
-        tmp.flush()
-        tmp_path = tmp.name
-    try:
-        pattern: EmbPattern = read(tmp_path)
-        points: List[Dict[str, Any]] = []
-        for stitch in pattern.stitches:
-            x, y, flags = stitch[0], stitch[1], stitch[2]
-            points.append({"x": float(x), "y": float(y), "type": stitch_flags_to_str(flags)})
-        info = {
-            "stitch_count": len([p for p in points if p["type"] == "stitch"]),
-            "jump_count": len([p for p in points if p["type"] == "jump"]),
-            "trim_count": len([p for p in points if p["type"] == "trim"]),
-            "color_changes": len([p for p in points if p["type"] == "color_change"]),
-        }
-        return {"ok": True, "points": points, "info": info}
-    finally:
-        try:
-            os.remove(tmp_path)
-        except Exception:
-            pass
+    reader = _machine_reader(fmt_hint)
+    if reader is None:
+        raise HTTPException(status_code=400, detail=f"Unsupported machine file format: {fmt_hint}")
+    # Readers consume streams directly, so the upload is never copied to another file
+    stream: Any = _as_stream(data)
+    if getattr(reader, "READ_FILE_IN_TEXT_MODE", False):
+        stream = io.TextIOWrapper(stream, encoding="utf-8", errors="replace")
+    pattern = EmbPattern()
+    reader.read(stream, pattern, None)
+    S = np.asarray(pattern.stitches, dtype=np.float64).reshape(-1, 3)
+    types = _FLAG_CODE_LUT[S[:, 2].astype(np.int64) & 0xFF]
+    counts = np.bincount(types, minlength=len(STITCH_TYPE_NAMES))
+    info = {
+        "stitch_count": int(counts[STITCH_TYPE_NAMES.index("stitch")]),
+        "jump_count": int(counts[STITCH_TYPE_NAMES.index("jump")]),
+        "trim_count": int(counts[STITCH_TYPE_NAMES.index("trim")]),
+        "color_changes": int(counts[STITCH_TYPE_NAMES.index("color_change")]),
+    }
+    plan = {"xs": S[:, 0], "ys": S[:, 1], "types": types, "info": info}
+    return plan_payload(plan, layout)
+
+def resample_polyline(xs: np.ndarray, ys: np.ndarray, spacing: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Resample a polyline at fixed arc-length spacing in one vectorized pass.
+
+    Returns (xs, ys, txs, tys): resampled positions and their unit tangents
+    (central differences, one-sided at the ends).
+    """
+    P = np.column_stack((xs, ys)).astype(np.float64, copy=False)
+    if len(P) >= 2:
+        seg = np.diff(P, axis=0)
+        L = np.hypot(seg[:, 0], seg[:, 1])
+        cum = np.concatenate(([0.0], np.cumsum(L)))
+        if cum[-1] > 1e-6:
+            _check_stitch_budget(cum[-1] / spacing)
+            targets = np.arange(0.0, cum[-1], spacing)
+            idx = np.clip(np.searchsorted(cum, targets, side="right") - 1, 0, len(L) - 1)
+            t = (targets - cum[idx]) / np.maximum(L[idx], 1e-12)
+            P_out = P[idx] + seg[idx] * t[:, None]
+            if not np.array_equal(P_out[-1], P[-1]):
+                P_out = np.vstack((P_out, P[-1]))
+            P = P_out
+        else:
+            P = P[:1]
+    T = unit_tangents(P)
+    return P[:, 0], P[:, 1], T[:, 0], T[:, 1]
+
+def normal_offsets(strategy: str, n: int, width_px: float, stitch_len_px: float, passes: int) -> Optional[np.ndarray]:
+    """Per-point offsets along the path normal for each polyline strategy.
+
+    Returns an (n, k) array: row i holds the k signed offsets emitted around
+    resampled point i, in stitch order. 'outline' stays on the centerline (None).
+    """
+    idx = np.arange(n)
+    half = width_px * 0.5
+    if strategy == "outline":
+        return None
+    if strategy == "satin":
+        # alternate sides; multi-pass offsets are narrower on later passes
+        n_pass = max(1, passes)
+        side = np.where(idx % 2, -1.0, 1.0)
+        return side[:, None] * (half * (1.0 - np.arange(n_pass) / n_pass))[None, :]
+    if strategy == "zigzag":
+        # Similar to satin but a fixed amplitude sawtooth along the normal
+        return np.where(idx % 2, -half, half)[:, None]
+    if strategy == "double_satin":
+        # Two satin rails side-by-side
+        return np.broadcast_to(np.array([width_px * 0.25, -half]), (n, 2))
+    if strategy == "meander":
+        # Sinusoidal meander around the path normal
+        freq = max(0.2, 2.0 / max(1.0, stitch_len_px))
+        return (np.sin(freq * (idx + 1)) * half)[:, None]
+    if strategy == "ripple":
+        # Radial-like ripple perpendicular to tangent with decaying amplitude
+        return ((0.5 + 0.5 * np.sin(0.5 * (idx + 1))) * half)[:, None]
+    bands = max(1, int(max(2.0, width_px) // max(1.0, stitch_len_px)))
+    # contour: parallel contours around the centerline; fill: every band in between
+    step = 2 if strategy == "contour" else 1
+    offs = (np.arange(-bands, bands + 1, step) / bands) * half
+    return np.broadcast_to(offs, (n, len(offs)))
+
+def _expand_along_normals_np(bx: np.ndarray, by: np.ndarray, txs: np.ndarray, tys: np.ndarray,
+                             k: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # normal = (-ty, tx)
+    return (bx[:, None] - k * tys[:, None]).ravel(), (by[:, None] + k * txs[:, None]).ravel()
+
+if _HAS_NUMBA:
+    @njit(cache=True, fastmath=True, boundscheck=False)
+    def _expand_along_normals_jit(bx, by, txs, tys, k):
+        n, m = k.shape
+        ox = np.empty(n * m)
+        oy = np.empty(n * m)
+        for i in range(n):
+            for j in range(m):
+                ox[i * m + j] = bx[i] - k[i, j] * tys[i]
+                oy[i * m + j] = by[i] + k[i, j] * txs[i]
+        return ox, oy
+
+def expand_along_normals(bx: np.ndarray, by: np.ndarray, txs: np.ndarray, tys: np.ndarray,
+                         k: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Offset each resampled point along its normal by every entry of its row in k."""
+    if _HAS_NUMBA:
+        return _expand_along_normals_jit(bx, by, txs, tys, np.ascontiguousarray(k, dtype=np.float64))
+    return _expand_along_normals_np(bx, by, txs, tys, k)
+
+@app.on_event("startup")
+def _warm_kernels() -> None:
+    """Compile the JIT kernels before the first request pays for it."""
+    if _HAS_NUMBA:
+        z = np.zeros(4)
+        expand_along_normals(z, z, z, z, np.zeros((4, 2)))
+        mean_pair_distance(np.zeros((2, 3)))
+        c = np.zeros((1, 4))
+        _sample_beziers_jit(c, c, np.array(_DENSE_SIZES[:1]), np.zeros(1, dtype=np.bool_),
+                            np.zeros(1, dtype=np.bool_), np.ones(1, dtype=np.bool_), 1.0, 4)
+
+@app.on_event("shutdown")
+def _stop_pools() -> None:
+    """Stop the SVG worker processes and upscale threads with the app."""
+    if _SVG_POOL is not None:
+        _SVG_POOL.shutdown(wait=False, cancel_futures=True)
+    _UPSCALE_POOL.shutdown(wait=False, cancel_futures=True)
 
 @app.get("/health")
 def health():
@@ -303,12 +818,14 @@ def inkstitch_health():
     }
 
 @app.post("/embroidery/plan")
-async def embroidery_plan(machine_file: UploadFile = File(...), format: str = Query("dst")):
+async def embroidery_plan(machine_file: UploadFile = File(...), format: str = Query("dst"),
+                          layout: str = Query("points")):
     """Accept a machine file (DST/PES/...) and return a stitch plan JSON for 3D preview."""
-    data = await machine_file.read()
     try:
-        plan = parse_machine_file_to_plan(data, fmt_hint=format.lower())
-        return JSONResponse(plan)
+        # Parse straight from the spooled upload (on disk past 1 MiB); pyembroidery is CPU-bound,
+        # so keep it off the event loop
+        plan = await asyncio.to_thread(parse_machine_file_to_plan, machine_file.file, fmt_hint=format.lower(), layout=layout)
+        return FastJSONResponse(plan)
     except HTTPException as he:
         raise he
     except Exception as e:
@@ -320,27 +837,31 @@ async def embroidery_generate(
     mm_per_px: float = Query(0.26, gt=0),
     stitch_len_mm: float = Query(2.5, gt=0),
     strategy: str = Query("outline"),
-    density: float = Query(1.0, gt=0),
-    return_dst: bool = Query(False)
+    density: float = Query(1.0, gt=0, le=100),
+    return_dst: bool = Query(False),
+    layout: str = Query("points")
 ):
     """Generate a stitch plan from an SVG using a chosen strategy.
 
     strategy = outline | satin | fill (basic fill placeholder)
     density  = density multiplier for stitches
+    layout   = points | soa (ignored when return_dst is set)
     """
-    data = await svg_file.read()
-    plan = svg_to_stitches(
-        data,
+    # The spooled upload is hashed and parsed in place rather than read into memory first
+    plan = await asyncio.to_thread(
+        svg_to_stitches,
+        svg_file.file,
         mm_per_px=mm_per_px,
         stitch_len_mm=stitch_len_mm,
         strategy=strategy,
         density=density,
+        layout="soa" if return_dst else layout,
     )
     if not return_dst:
-        return JSONResponse(plan)
+        return FastJSONResponse(plan)
     # Return DST binary from plan
     try:
-        dst_bytes = running_stitches_to_dst(plan["points"])  # type: ignore
+        dst_bytes = await asyncio.to_thread(plan_to_dst, plan)
         return Response(dst_bytes, media_type="application/octet-stream")
     except HTTPException as he:
         raise he
@@ -360,189 +881,118 @@ async def embroidery_export_from_points(
     if fmt != "dst":
         raise HTTPException(status_code=400, detail="Only DST export is supported at the moment")
     try:
-        dst_bytes = running_stitches_to_dst(pts)
+        dst_bytes = await asyncio.to_thread(running_stitches_to_dst, pts)
         return Response(dst_bytes, media_type="application/octet-stream")
     except HTTPException as he:
         raise he
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to export from points: {e}")
 
-@app.post("/embroidery/generate_from_points")
-async def embroidery_generate_from_points(req: GenerateFromPointsReq):
+@app.post(
+    "/embroidery/generate_from_points",
+    openapi_extra={"requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": GenerateFromPointsReq.model_json_schema()}},
+    }},
+)
+async def embroidery_generate_from_points(request: Request):
     """Generate stitch plan from freehand polyline points in PIXEL space.
 
     Strategies:
     - outline: resample along the path at stitch_len_mm/density spacing.
     - satin: alternate offsets across path normals using width_mm and passes.
     - fill: create bands across normal around each resampled point.
+
+    The body matches GenerateFromPointsReq, but only the scalar fields go through
+    Pydantic; the (potentially huge) points list is read straight into NumPy.
     """
-    pts = req.points or []
+    try:
+        body = json_loads(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Request body must be valid JSON")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="Request body must be a JSON object")
+    try:
+        req = GenerateFromPointsParams.model_validate({k: v for k, v in body.items() if k != "points"})
+    except ValidationError as e:
+        raise RequestValidationError([{**err, "loc": ("body", *err["loc"])} for err in e.errors()])
+    pts = body.get("points") or []
+    try:
+        px = np.fromiter((p["x"] for p in pts), dtype=np.float64, count=len(pts))
+        py = np.fromiter((p["y"] for p in pts), dtype=np.float64, count=len(pts))
+    except (TypeError, ValueError, KeyError):
+        raise HTTPException(status_code=422, detail="points must be a list of {x: number, y: number}")
     if len(pts) < 2:
-        return JSONResponse({"ok": True, "points": [], "info": {"stitch_count": 0}})
+        empty = {"xs": [], "ys": [], "types": [], "color_changes": [], "info": {"stitch_count": 0}}
+        return FastJSONResponse(plan_payload(empty, req.layout))
 
     stitch_len_px = (req.stitch_len_mm / req.mm_per_px if req.mm_per_px > 0 else req.stitch_len_mm)
     if req.density > 0:
         stitch_len_px = stitch_len_px / max(0.25, req.density)
     width_px = (req.width_mm / req.mm_per_px if req.mm_per_px > 0 else req.width_mm)
 
-    def resample_polyline(points: List[Dict[str, float]], spacing: float) -> List[Dict[str, float]]:
-        if len(points) < 2:
-            return points
-        out: List[Dict[str, float]] = []
-        acc = 0.0
-        out.append({"x": float(points[0]["x"]), "y": float(points[0]["y"])})
-        for i in range(1, len(points)):
-            x0, y0 = float(points[i-1]["x"]), float(points[i-1]["y"]) 
-            x1, y1 = float(points[i]["x"]), float(points[i]["y"]) 
-            dx, dy = x1-x0, y1-y0
-            seg_len = math.hypot(dx, dy)
-            if seg_len <= 1e-6:
-                continue
-            ux, uy = dx/seg_len, dy/seg_len
-            while acc + spacing <= seg_len:
-                acc += spacing
-                out.append({"x": x0 + ux*acc, "y": y0 + uy*acc})
-            acc = (acc + seg_len) % spacing
-        if out[-1]["x"] != pts[-1]["x"] or out[-1]["y"] != pts[-1]["y"]:
-            out.append({"x": float(pts[-1]["x"]), "y": float(pts[-1]["y"])})
-        return out
-
-    def tangent_at(points: List[Dict[str, float]], i: int) -> tuple:
-        if i <= 0:
-            x0, y0 = float(points[0]["x"]), float(points[0]["y"]) 
-            x1, y1 = float(points[1]["x"]), float(points[1]["y"]) 
-        elif i >= len(points)-1:
-            x0, y0 = float(points[-2]["x"]), float(points[-2]["y"]) 
-            x1, y1 = float(points[-1]["x"]), float(points[-1]["y"]) 
-        else:
-            x0, y0 = float(points[i-1]["x"]), float(points[i-1]["y"]) 
-            x1, y1 = float(points[i+1]["x"]), float(points[i+1]["y"]) 
-        dx, dy = x1-x0, y1-y0
-        mag = math.hypot(dx, dy) or 1.0
-        return (dx/mag, dy/mag)
-
-    base = resample_polyline(pts, max(1.0, stitch_len_px))
-    plan_pts: List[Dict[str, Any]] = []
-
-    # Seed color as a single layer (client can colorize per stroke group later)
-    plan_pts.append({"x": float(base[0]["x"]), "y": float(base[0]["y"]), "type": "color_change", "color": "#000000"})
-
-    if req.strategy == "outline":
-        for b in base:
-            plan_pts.append({"x": float(b["x"]), "y": float(b["y"]), "type": "stitch"})
-    elif req.strategy == "satin":
-        side = 1.0
-        for i, b in enumerate(base):
-            tx, ty = tangent_at(base, i)
-            nx, ny = -ty, tx
-            # multi-pass offsets: narrower on later passes
-            for pp in range(max(1, req.passes)):
-                off = (width_px * (1.0 - (pp / max(1, req.passes)))) * 0.5
-                plan_pts.append({
-                    "x": float(b["x"]) + side * off * nx,
-                    "y": float(b["y"]) + side * off * ny,
-                    "type": "stitch"
-                })
-            side *= -1.0
-    elif req.strategy == "zigzag":
-        # Similar to satin but use a sawtooth spacing along the normal with fixed amplitude
-        amp = width_px * 0.5
-        step = max(1.0, stitch_len_px)
-        toggle = 1.0
-        for i, b in enumerate(base):
-            tx, ty = tangent_at(base, i)
-            nx, ny = -ty, tx
-            plan_pts.append({
-                "x": float(b["x"]) + toggle * amp * nx,
-                "y": float(b["y"]) + toggle * amp * ny,
-                "type": "stitch"
-            })
-            toggle *= -1.0
-    elif req.strategy == "double_satin":
-        # Two satin rails side-by-side
-        for i, b in enumerate(base):
-            tx, ty = tangent_at(base, i)
-            nx, ny = -ty, tx
-            offA = width_px * 0.25
-            offB = width_px * 0.5
-            plan_pts.append({"x": float(b["x"]) + offA * nx, "y": float(b["y"]) + offA * ny, "type": "stitch"})
-            plan_pts.append({"x": float(b["x"]) - offB * nx, "y": float(b["y"]) - offB * ny, "type": "stitch"})
-    elif req.strategy == "meander":
-        # Sinusoidal meander around the path normal
-        freq = max(0.2, 2.0 / max(1.0, stitch_len_px))
-        phase = 0.0
-        for i, b in enumerate(base):
-            tx, ty = tangent_at(base, i)
-            nx, ny = -ty, tx
-            phase += freq
-            off = math.sin(phase) * (width_px * 0.5)
-            plan_pts.append({"x": float(b["x"]) + off * nx, "y": float(b["y"]) + off * ny, "type": "stitch"})
-    elif req.strategy == "contour":
-        # Multiple parallel contours around the centerline
-        bands = max(1, int(max(2.0, width_px) // max(1.0, stitch_len_px)))
-        for i, b in enumerate(base):
-            tx, ty = tangent_at(base, i)
-            nx, ny = -ty, tx
-            for bi in range(-bands, bands + 1, 2):
-                off = (bi / max(1, bands)) * (width_px * 0.5)
-                plan_pts.append({"x": float(b["x"]) + off * nx, "y": float(b["y"]) + off * ny, "type": "stitch"})
-    elif req.strategy == "ripple":
-        # Radial-like ripple perpendicular to tangent with decaying amplitude
-        phase = 0.0
-        for i, b in enumerate(base):
-            tx, ty = tangent_at(base, i)
-            nx, ny = -ty, tx
-            phase += 0.5
-            amp = (0.5 + 0.5*math.sin(phase)) * (width_px * 0.5)
-            plan_pts.append({"x": float(b["x"]) + amp * nx, "y": float(b["y"]) + amp * ny, "type": "stitch"})
-    else:  # fill
-        bands = max(1, int(max(2.0, width_px) // max(1.0, stitch_len_px)))
-        for i, b in enumerate(base):
-            tx, ty = tangent_at(base, i)
-            nx, ny = -ty, tx
-            for bi in range(-bands, bands + 1):
-                off = (bi / max(1, bands)) * (width_px * 0.5)
-                plan_pts.append({
-                    "x": float(b["x"]) + off * nx,
-                    "y": float(b["y"]) + off * ny,
-                    "type": "stitch"
-                })
+    bx, by, txs, tys = resample_polyline(px, py, max(1.0, stitch_len_px))
+    # Every strategy's total is samples x offsets; check it before any offsets are built
+    _check_stitch_budget(len(bx) * _offsets_per_point(req.strategy, stitch_len_px, width_px, req.passes))
+    k = normal_offsets(req.strategy, len(bx), width_px, stitch_len_px, req.passes)
+    if k is None:
+        xs, ys = bx, by
+    else:
+        xs, ys = expand_along_normals(bx, by, txs, tys, k)
 
     info = {
-        "stitch_count": len([p for p in plan_pts if p.get("type") == "stitch"]),
+        "stitch_count": len(xs),
         "strategy": req.strategy,
         "mm_per_px": req.mm_per_px,
         "stitch_len_mm": req.stitch_len_mm,
         "width_mm": req.width_mm,
         "passes": req.passes,
     }
-    return JSONResponse({"ok": True, "points": plan_pts, "info": info})
+    plan = {
+        "xs": xs,
+        "ys": ys,
+        "types": np.zeros(len(xs), dtype=np.uint8),
+        # Seed color as a single layer (client can colorize per stroke group later)
+        "color_changes": [{"at": 0, "color": "#000000"}] if len(xs) else [],
+        "info": info,
+    }
+    return FastJSONResponse(plan_payload(plan, req.layout))
 
 # Revolutionary AI-Powered Endpoints
 
+# Stitch vocabulary per complexity level
+_STITCH_TYPES: Dict[str, Tuple[str, ...]] = {
+    "beginner": ("satin", "fill", "outline"),
+    "intermediate": ("satin", "fill", "outline", "cross-stitch", "chain"),
+    "advanced": ("satin", "fill", "outline", "cross-stitch", "chain", "backstitch",
+                 "french-knot", "lazy-daisy", "feather"),
+    "expert": ("satin", "fill", "outline", "cross-stitch", "chain", "backstitch",
+               "french-knot", "bullion", "lazy-daisy", "feather", "couching", "appliqué",
+               "seed", "stem", "metallic", "glow-thread", "variegated", "gradient"),
+}
+# Design keywords in priority order, matched anywhere in the description
+_DESIGN_KINDS = ("flower", "heart", "star")
+_DESIGN_RE = re.compile("|".join(_DESIGN_KINDS), re.IGNORECASE)
+
+def _design_kind(description: str) -> Optional[str]:
+    """Highest-priority design keyword mentioned in a description, if any."""
+    found = {m.lower() for m in _DESIGN_RE.findall(description)}
+    return next((k for k in _DESIGN_KINDS if k in found), None)
+
 @app.post("/ai/generate-design")
 async def generate_ai_design(req: AIDesignReq):
     """Generate AI-powered embroidery design based on description."""
     try:
         # AI-powered design generation logic
-        stitch_types = {
-            "beginner": ["satin", "fill", "outline"],
-            "intermediate": ["satin", "fill", "outline", "cross-stitch", "chain"],
-            "advanced": ["satin", "fill", "outline", "cross-stitch", "chain", "backstitch", 
-                        "french-knot", "lazy-daisy", "feather"],
-            "expert": ["satin", "fill", "outline", "cross-stitch", "chain", "backstitch",
-                      "french-knot", "bullion", "lazy-daisy", "feather", "couching", "appliqué",
-                      "seed", "stem", "metallic", "glow-thread", "variegated", "gradient"]
-        }
-        
-        available_stitches = stitch_types.get(req.stitchComplexity, stitch_types["beginner"])
+        available_stitches = list(_STITCH_TYPES.get(req.stitchComplexity, _STITCH_TYPES["beginner"]))
         
         # Generate design based on description
-        if "flower" in req.description.lower():
+        kind = _design_kind(req.description)
+        if kind == "flower":
             stitches = generate_flower_pattern(req.canvas_width, req.canvas_height, available_stitches)
-        elif "heart" in req.description.lower():
+        elif kind == "heart":
             stitches = generate_heart_pattern(req.canvas_width, req.canvas_height, available_stitches)
-        elif "star" in req.description.lower():
+        elif kind == "star":
             stitches = generate_star_pattern(req.canvas_width, req.canvas_height, available_stitches)
         else:
             stitches = generate_abstract_pattern(req.description, req.canvas_width, req.canvas_height, available_stitches)
@@ -553,7 +1003,7 @@ async def generate_ai_design(req: AIDesignReq):
             {"type": "pattern", "suggestion": "Consider adding a border outline"}
         ]
         
-        return JSONResponse({
+        return FastJSONResponse({
             "ok": True,
             "stitches": stitches,
             "suggestions": suggestions,
@@ -564,26 +1014,38 @@ async def generate_ai_design(req: AIDesignReq):
             }
         })
     except Exception as e:
-        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+        return FastJSONResponse({"ok": False, "error": str(e)}, status_code=500)
 
 @app.post("/ai/optimize-path")
 async def optimize_stitch_path(req: OptimizePathReq):
     """Optimize stitch path using ML algorithms."""
     try:
-        # ML-based path optimization
-        optimized_stitches = optimize_stitch_sequence(req.stitches, req.fabricPhysics)
+        # ML-based path optimization; the geometry is packed once and shared by every stat
+        batch = StitchBatch.from_dicts(req.stitches)
+        order = stitch_tour(batch) if req.stitches else np.zeros(0, dtype=np.int64)
+        optimized_stitches = [req.stitches[i] for i in order]
+        lengths = batch.lengths()
+        original_length = float(lengths.sum())
+        optimized_length = float(lengths[order].sum())
+        # Reordering only shortens the jumps between stitches, so report those separately
+        original_travel = batch.travel_length()
+        optimized_travel = batch.travel_length(order)
         
-        return JSONResponse({
+        return FastJSONResponse({
             "ok": True,
             "stitches": optimized_stitches,
             "optimization_stats": {
-                "original_length": calculate_total_length(req.stitches),
-                "optimized_length": calculate_total_length(optimized_stitches),
-                "efficiency_gain": calculate_efficiency_gain(req.stitches, optimized_stitches)
+                "original_length": original_length,
+                "optimized_length": optimized_length,
+                "efficiency_gain": _gain_percent(original_length, optimized_length),
+                "original_travel": original_travel,
+                "optimized_travel": optimized_travel,
+                "efficiency_gain_with_travel": _gain_percent(original_length + original_travel,
+                                                             optimized_length + optimized_travel)
             }
         })
     except Exception as e:
-        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+        return FastJSONResponse({"ok": False, "error": str(e)}, status_code=500)
 
 @app.post("/ai/suggest-colors")
 async def suggest_thread_colors(req: SuggestColorsReq):
@@ -594,7 +1056,7 @@ async def suggest_thread_colors(req: SuggestColorsReq):
         
         suggestions = generate_color_suggestions(current_colors, req.fabricType, req.designStyle)
         
-        return JSONResponse({
+        return FastJSONResponse({
             "ok": True,
             "colors": suggestions,
             "analysis": {
@@ -604,7 +1066,7 @@ async def suggest_thread_colors(req: SuggestColorsReq):
             }
         })
     except Exception as e:
-        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+        return FastJSONResponse({"ok": False, "error": str(e)}, status_code=500)
 
 @app.websocket("/collaborate")
 async def websocket_collaboration(websocket):
@@ -623,6 +1085,17 @@ async def websocket_collaboration(websocket):
 
 # Helper functions for AI features
 
+# Pattern geometry as offsets from the canvas center, computed once at import
+_PETAL_TIPS = 30 * np.column_stack((np.cos(np.arange(8) * np.pi / 4), np.sin(np.arange(8) * np.pi / 4)))
+_HEART_OFFSETS = np.array([(0, 20), (-15, -10), (-25, -5), (-20, 5), (0, 25), (20, 5), (25, -5), (15, -10)])
+_STAR_ANGLES = np.arange(10) * np.pi / 5 - np.pi / 2
+_STAR_OFFSETS = np.where(np.arange(10) % 2 == 0, 25, 12)[:, None] * np.column_stack(
+    (np.cos(_STAR_ANGLES), np.sin(_STAR_ANGLES)))
+
+def _placed(offsets: np.ndarray, center_x: int, center_y: int) -> List[Dict[str, float]]:
+    """Translate center-relative geometry to the canvas as [{x, y}] points."""
+    return [{"x": x, "y": y} for x, y in (offsets + (center_x, center_y)).tolist()]
+
 def generate_flower_pattern(width: int, height: int, stitch_types: List[str]) -> List[Dict]:
     """Generate a flower pattern using available stitch types."""
     center_x, center_y = width // 2, height // 2
@@ -641,14 +1114,11 @@ def generate_flower_pattern(width: int, height: int, stitch_types: List[str]) ->
     
     # Petals with lazy daisy if available
     if "lazy-daisy" in stitch_types:
-        for i in range(8):
-            angle = (i * 45) * math.pi / 180
-            petal_x = center_x + 30 * math.cos(angle)
-            petal_y = center_y + 30 * math.sin(angle)
+        for i, tip in enumerate(_placed(_PETAL_TIPS, center_x, center_y)):
             stitches.append({
                 "id": f"petal_{i}",
                 "type": "lazy-daisy",
-                "points": [{"x": center_x, "y": center_y}, {"x": petal_x, "y": petal_y}],
+                "points": [{"x": center_x, "y": center_y}, tip],
                 "color": "#FF69B4",
                 "thickness": 2,
                 "opacity": 1.0
@@ -662,16 +1132,7 @@ def generate_heart_pattern(width: int, height: int, stitch_types: List[str]) ->
     stitches = []
     
     # Heart outline
-    heart_points = [
-        {"x": center_x, "y": center_y + 20},
-        {"x": center_x - 15, "y": center_y - 10},
-        {"x": center_x - 25, "y": center_y - 5},
-        {"x": center_x - 20, "y": center_y + 5},
-        {"x": center_x, "y": center_y + 25},
-        {"x": center_x + 20, "y": center_y + 5},
-        {"x": center_x + 25, "y": center_y - 5},
-        {"x": center_x + 15, "y": center_y - 10}
-    ]
+    heart_points = _placed(_HEART_OFFSETS, center_x, center_y)
     
     stitches.append({
         "id": "heart_outline",
@@ -690,13 +1151,7 @@ def generate_star_pattern(width: int, height: int, stitch_types: List[str]) -> L
     stitches = []
     
     # 5-pointed star
-    star_points = []
-    for i in range(10):
-        angle = (i * 36) * math.pi / 180
-        radius = 25 if i % 2 == 0 else 12
-        x = center_x + radius * math.cos(angle - math.pi/2)
-        y = center_y + radius * math.sin(angle - math.pi/2)
-        star_points.append({"x": x, "y": y})
+    star_points = _placed(_STAR_OFFSETS, center_x, center_y)
     
     stitches.append({
         "id": "star",
@@ -735,53 +1190,129 @@ def generate_abstract_pattern(description: str, width: int, height: int, stitch_
     
     return stitches
 
+# Neighbours fetched per KD-tree query before falling back to a full scan
+_NN_K = 16
+
+def _greedy_chain(starts: np.ndarray, ends: np.ndarray, origin: np.ndarray) -> List[int]:
+    """Greedy nearest-neighbour visiting order: hop from the current end to the closest unvisited start."""
+    # Distances in float64, so equally long hops compare equal and the tie-break below holds
+    starts = np.asarray(starts, dtype=np.float64)
+    ends = np.asarray(ends, dtype=np.float64)
+    n = len(starts)
+    alive = np.ones(n, dtype=bool)
+    ids = np.arange(n)  # tree row -> stitch index
+    tree = cKDTree(starts) if _HAS_SCIPY else None
+    order: List[int] = []
+    cur = origin
+    for step in range(n):
+        j = -1
+        if tree is not None:
+            # Rebuild over the survivors once half the tree is visited, so neighbourhoods stay live
+            if 2 * (n - step) < len(ids):
+                ids = np.flatnonzero(alive)
+                tree = cKDTree(starts[ids])
+            k = min(_NN_K, len(ids))
+            dist, hits = tree.query(cur, k=k)
+            dist, hits = np.atleast_1d(dist), ids[np.atleast_1d(hits)]
+            live = alive[hits]
+            if live.any():
+                d2 = np.where(live, np.einsum("ij,ij->i", starts[hits] - cur, starts[hits] - cur), np.inf)
+                best = d2.min()
+                # Ties go to the lowest index; if the tie may run past the k-th hit, scan instead
+                if k == len(ids) or dist[-1] ** 2 > best * (1 + 1e-9):
+                    j = int(hits[d2 == best].min())
+        if j < 0:
+            d2 = np.einsum("ij,ij->i", starts - cur, starts - cur)
+            d2[~alive] = np.inf
+            j = int(np.argmin(d2))
+        alive[j] = False
+        order.append(j)
+        cur = ends[j]
+    return order
+
+@dataclass(frozen=True)
+class StitchBatch:
+    """SoA view of a list of stitch dicts: every point in one array plus per-stitch offsets.
+
+    Stitch i owns xy[offsets[i]:offsets[i + 1]]. Built once at the API boundary so
+    the geometry helpers never walk the {"x", "y"} dicts themselves.
+    """
+    xy: np.ndarray       # (n, 2) float32; pixel coordinates never need double precision
+    offsets: np.ndarray  # (len(stitches) + 1,) int64
+
+    @classmethod
+    def from_dicts(cls, stitches: List[Dict]) -> "StitchBatch":
+        """Pack request stitches ({"points": [{x, y}, ...], ...}) into one array."""
+        counts = [len(stitch.get("points") or ()) for stitch in stitches]
+        n = sum(counts)
+        xy = np.fromiter(
+            (c for stitch in stitches for p in stitch.get("points") or () for c in (p["x"], p["y"])),
+            dtype=np.float32, count=2 * n,
+        ).reshape(n, 2)
+        return cls(xy, np.concatenate(([0], np.cumsum(counts, dtype=np.int64))))
+
+    def lengths(self) -> np.ndarray:
+        """Polyline length of each stitch."""
+        a, b = self.offsets[:-1], self.offsets[1:]
+        if len(self.xy) < 2:
+            return np.zeros(len(a))
+        d = np.diff(self.xy, axis=0)
+        # float32 segments, float64 running sum: the prefix differences below would
+        # otherwise lose whole pixels once the cumulative length passes ~10^7
+        cum = np.concatenate(([0.0], np.cumsum(np.hypot(d[:, 0], d[:, 1]), dtype=np.float64)))
+        # edges a..b-2 belong to the stitch; the hop edge b-1 -> b is never counted
+        return np.where(b - a >= 2, cum[np.maximum(b - 1, 0)] - cum[np.minimum(a, len(cum) - 1)], 0.0)
+
+    def travel_length(self, order: Optional[np.ndarray] = None) -> float:
+        """Length of the jumps from each stitch's last point to the next stitch's first point."""
+        idx = np.arange(len(self.offsets) - 1) if order is None else np.asarray(order)
+        idx = idx[self.offsets[idx + 1] > self.offsets[idx]]  # empty stitches are skipped over
+        if len(idx) < 2:
+            return 0.0
+        d = self.xy[self.offsets[idx[1:]]] - self.xy[self.offsets[idx[:-1] + 1] - 1]
+        return float(np.hypot(d[:, 0], d[:, 1]).sum(dtype=np.float64))
+
+def stitch_tour(batch: StitchBatch) -> np.ndarray:
+    """Stitch visiting order: the first stitch, then always the one starting closest to the last end."""
+    counts = np.diff(batch.offsets)
+    rest = np.arange(1, len(counts))
+    drawn = rest[counts[1:] > 0]
+    # Stitches without points can never be the closest, so they trail in input order
+    empty = rest[counts[1:] == 0]
+    if len(drawn):
+        starts = batch.xy[batch.offsets[drawn]]
+        ends = batch.xy[batch.offsets[drawn + 1] - 1]
+        origin = batch.xy[batch.offsets[1] - 1] if counts[0] else np.zeros(2)
+        drawn = drawn[_greedy_chain(starts, ends, origin)]
+    return np.concatenate(([0], drawn, empty)).astype(np.int64)
+
 def optimize_stitch_sequence(stitches: List[Dict], fabric_physics: Dict) -> List[Dict]:
-    """Optimize stitch sequence for efficiency."""
-    # Simple optimization: sort by distance
+    """Optimize stitch sequence for efficiency.
+
+    List-of-dicts wrapper around stitch_tour, kept for existing callers.
+    """
     if not stitches:
         return stitches
-    
-    optimized = [stitches[0]]
-    remaining = stitches[1:]
-    
-    while remaining:
-        last_stitch = optimized[-1]
-        last_point = last_stitch["points"][-1] if last_stitch["points"] else {"x": 0, "y": 0}
-        
-        # Find closest next stitch
-        closest_idx = 0
-        min_distance = float('inf')
-        
-        for i, stitch in enumerate(remaining):
-            if stitch["points"]:
-                first_point = stitch["points"][0]
-                distance = math.sqrt(
-                    (first_point["x"] - last_point["x"])**2 + 
-                    (first_point["y"] - last_point["y"])**2
-                )
-                if distance < min_distance:
-                    min_distance = distance
-                    closest_idx = i
-        
-        optimized.append(remaining.pop(closest_idx))
-    
-    return optimized
+    return [stitches[i] for i in stitch_tour(StitchBatch.from_dicts(stitches))]
 
 def calculate_total_length(stitches: List[Dict]) -> float:
     """Calculate total stitch length."""
-    total = 0
-    for stitch in stitches:
-        points = stitch.get("points", [])
-        for i in range(len(points) - 1):
-            p1, p2 = points[i], points[i + 1]
-            total += math.sqrt((p2["x"] - p1["x"])**2 + (p2["y"] - p1["y"])**2)
-    return total
+    return float(StitchBatch.from_dicts(stitches).lengths().sum())
+
+def _gain_percent(before: float, after: float) -> float:
+    """Relative reduction from before to after, in percent."""
+    return ((before - after) / before) * 100 if before > 0 else 0
 
 def calculate_efficiency_gain(original: List[Dict], optimized: List[Dict]) -> float:
-    """Calculate efficiency gain percentage."""
-    original_length = calculate_total_length(original)
-    optimized_length = calculate_total_length(optimized)
-    return ((original_length - optimized_length) / original_length) * 100 if original_length > 0 else 0
+    """Calculate efficiency gain percentage (of total stitch length, as before)."""
+    return _gain_percent(calculate_total_length(original), calculate_total_length(optimized))
+
+# Thread colors that read well on each fabric
+_FABRIC_PALETTES: Dict[str, Tuple[str, ...]] = {
+    "cotton": ("#FFFFFF", "#F5F5F5", "#E0E0E0"),
+    "silk": ("#FFD700", "#C0C0C0", "#E6E6FA"),
+    "denim": ("#000080", "#4169E1", "#87CEEB"),
+}
 
 def generate_color_suggestions(current_colors: List[str], fabric_type: str, design_style: str) -> List[str]:
     """Generate color suggestions based on current palette."""
@@ -789,37 +1320,54 @@ def generate_color_suggestions(current_colors: List[str], fabric_type: str, desi
     
     # Add complementary colors
     for color in current_colors[:3]:  # Limit to first 3 colors
-        if color.startswith('#'):
-            # Simple complementary color generation
-            r = int(color[1:3], 16)
-            g = int(color[3:5], 16)
-            b = int(color[5:7], 16)
-            comp_r = 255 - r
-            comp_g = 255 - g
-            comp_b = 255 - b
-            suggestions.append(f"#{comp_r:02x}{comp_g:02x}{comp_b:02x}")
+        if _HEX_RE.fullmatch(color):
+            # Complement = invert all 24 RGB bits at once
+            suggestions.append(f"#{int(color[1:], 16) ^ 0xFFFFFF:06x}")
     
     # Add fabric-appropriate colors
-    if fabric_type == "cotton":
-        suggestions.extend(["#FFFFFF", "#F5F5F5", "#E0E0E0"])
-    elif fabric_type == "silk":
-        suggestions.extend(["#FFD700", "#C0C0C0", "#E6E6FA"])
-    elif fabric_type == "denim":
-        suggestions.extend(["#000080", "#4169E1", "#87CEEB"])
+    suggestions.extend(_FABRIC_PALETTES.get(fabric_type, ()))
     
     return suggestions[:5]  # Return top 5 suggestions
 
+# Color-name keywords for palettes given by name rather than hex
+_WARM_NAMES = frozenset(("red", "orange", "yellow", "pink"))
+_COOL_NAMES = frozenset(("blue", "green", "purple", "cyan"))
+
+def _hue_degrees(rgb: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Hue in degrees [0, 360) for (k, 3) RGB rows, plus a mask of chromatic (non-gray) rows."""
+    mx = rgb.max(axis=1)
+    chroma = mx - rgb.min(axis=1)
+    safe = np.where(chroma > 0, chroma, 1.0)
+    r, g, b = rgb.T
+    h = np.where(mx == r, ((g - b) / safe) % 6.0,
+                 np.where(mx == g, (b - r) / safe + 2.0, (r - g) / safe + 4.0))
+    return h * 60.0, chroma > 0
+
+_PALETTE_CACHE_SIZE = 4096
+
+def _canon_palette(colors: List[str]) -> Tuple[str, ...]:
+    """Order- and case-insensitive cache key; theme and harmony depend only on the multiset."""
+    return tuple(sorted(c.lower() for c in colors))
+
 def determine_color_theme(colors: List[str]) -> str:
     """Determine the color theme of the current palette."""
+    return _color_theme(_canon_palette(colors))
+
+@lru_cache(maxsize=_PALETTE_CACHE_SIZE)
+def _color_theme(colors: Tuple[str, ...]) -> str:
     if not colors:
         return "neutral"
     
-    # Simple theme detection based on color analysis
-    warm_colors = ["red", "orange", "yellow", "pink"]
-    cool_colors = ["blue", "green", "purple", "cyan"]
-    
-    warm_count = sum(1 for color in colors if any(warm in color.lower() for warm in warm_colors))
-    cool_count = sum(1 for color in colors if any(cool in color.lower() for cool in cool_colors))
+    # Hex colors are classified by hue; named colors by keyword
+    hexes = [c for c in colors if c.startswith('#')]
+    names = [c for c in colors if not c.startswith('#')]
+    warm_count = sum(1 for name in names if any(warm in name for warm in _WARM_NAMES))
+    cool_count = sum(1 for name in names if any(cool in name for cool in _COOL_NAMES))
+    rgb = _parse_palette(hexes).astype(np.float64)
+    if len(rgb):
+        hue, chromatic = _hue_degrees(rgb)
+        warm_count += int(np.count_nonzero(chromatic & ((hue < 90) | (hue > 330))))
+        cool_count += int(np.count_nonzero(chromatic & (hue > 150) & (hue < 270)))
     
     if warm_count > cool_count:
         return "warm"
@@ -828,33 +1376,91 @@ def determine_color_theme(colors: List[str]) -> str:
     else:
         return "balanced"
 
+_HEX_RE = re.compile(r"#[0-9a-fA-F]{6}")
+_SMALL_PALETTE = 8  # below this, array setup costs more than the pair loop it saves
+
+def _parse_palette(colors: List[str]) -> np.ndarray:
+    """(k, 3) uint8 RGB rows for the well-formed #rrggbb entries, parsed in one bytes.fromhex call."""
+    valid = [c[1:] for c in colors if _HEX_RE.fullmatch(c)]
+    return np.frombuffer(bytes.fromhex("".join(valid)), dtype=np.uint8).reshape(-1, 3)
+
+_PAIR_TILE = 64
+_PDIST_MAX_ROWS = 1000  # pdist materialises all n(n-1)/2 distances; tile beyond this
+_MAX_RGB_DISTANCE = 441  # harmony scale; sqrt(3) * 255 rounded down
+
+_PARALLEL_PAIR_ROWS = 2000  # below this, thread start-up outweighs the split
+_PAIR_WORKERS = os.cpu_count() or 1
+
+def _pair_distance_sum_np(rgb: np.ndarray, lo: int, hi: int) -> float:
+    """Sum of distances from rows lo..hi-1 to every later row."""
+    n = len(rgb)
+    total = 0.0
+    # 64x64 tiles keep the broadcast small instead of materialising all n^2/2 pairs
+    for a in range(lo, hi, _PAIR_TILE):
+        rows = rgb[a:min(a + _PAIR_TILE, hi)]
+        for b in range(a, n, _PAIR_TILE):
+            d = rows[:, None, :] - rgb[None, b:b + _PAIR_TILE, :]
+            dist = np.sqrt(np.einsum("ijk,ijk->ij", d, d))
+            total += float((np.triu(dist, 1) if a == b else dist).sum())
+    return total
+
+if _HAS_NUMBA:
+    @njit(cache=True, fastmath=True, nogil=True)
+    def _pair_distance_sum_jit(rgb, lo, hi):
+        n = rgb.shape[0]
+        total = 0.0
+        for i in range(lo, hi):
+            for j in range(i + 1, n):
+                dr = rgb[j, 0] - rgb[i, 0]
+                dg = rgb[j, 1] - rgb[i, 1]
+                db = rgb[j, 2] - rgb[i, 2]
+                total += math.sqrt(dr * dr + dg * dg + db * db)
+        return total
+
+def _pair_distance_sum(rgb: np.ndarray, lo: int, hi: int) -> float:
+    if _HAS_NUMBA:
+        return float(_pair_distance_sum_jit(rgb, lo, hi))
+    return _pair_distance_sum_np(rgb, lo, hi)
+
+def mean_pair_distance(rgb: np.ndarray) -> float:
+    """Mean Euclidean distance over all unordered pairs of RGB rows (needs at least 2 rows)."""
+    n = len(rgb)
+    pairs = n * (n - 1) // 2
+    rgb = np.ascontiguousarray(rgb, dtype=np.float64)
+    if n > _PARALLEL_PAIR_ROWS and _PAIR_WORKERS > 1:
+        # The sum is associative and the kernels drop the GIL (numba outright, NumPy inside
+        # each tile), so row blocks spread over cores; early rows own more pairs, hence
+        # several blocks per worker
+        bounds = np.linspace(0, n, 4 * _PAIR_WORKERS + 1).astype(int).tolist()
+        with ThreadPoolExecutor(max_workers=_PAIR_WORKERS) as ex:
+            return sum(ex.map(_pair_distance_sum, repeat(rgb), bounds[:-1], bounds[1:])) / pairs
+    if not _HAS_NUMBA and _HAS_SCIPY and n <= _PDIST_MAX_ROWS:
+        return float(pdist(rgb).mean())
+    return _pair_distance_sum(rgb, 0, n) / pairs
+
 def calculate_color_harmony(colors: List[str]) -> float:
     """Calculate color harmony score (0-100)."""
+    return _color_harmony(_canon_palette(colors))
+
+@lru_cache(maxsize=_PALETTE_CACHE_SIZE)
+def _color_harmony(colors: Tuple[str, ...]) -> float:
     if len(colors) < 2:
         return 100.0
     
-    # Simple harmony calculation based on color distance
-    total_distance = 0
-    comparisons = 0
-    
-    for i in range(len(colors)):
-        for j in range(i + 1, len(colors)):
-            # Convert hex to RGB and calculate distance
-            try:
-                r1, g1, b1 = int(colors[i][1:3], 16), int(colors[i][3:5], 16), int(colors[i][5:7], 16)
-                r2, g2, b2 = int(colors[j][1:3], 16), int(colors[j][3:5], 16), int(colors[j][5:7], 16)
-                distance = math.sqrt((r2-r1)**2 + (g2-g1)**2 + (b2-b1)**2)
-                total_distance += distance
-                comparisons += 1
-            except:
-                continue
-    
-    if comparisons == 0:
-        return 100.0
-    
-    avg_distance = total_distance / comparisons
+    # Simple harmony calculation based on color distance; unparseable colors sit out every pair
+    if len(colors) < _SMALL_PALETTE:
+        # A handful of pairs: math.dist over the raw 3-byte rows beats allocating arrays
+        rows = [bytes.fromhex(c[1:]) for c in colors if _HEX_RE.fullmatch(c)]
+        if len(rows) < 2:
+            return 100.0
+        avg_distance = sum(math.dist(a, b) for a, b in combinations(rows, 2)) / (len(rows) * (len(rows) - 1) // 2)
+    else:
+        rgb = _parse_palette(colors).astype(np.float64)
+        if len(rgb) < 2:
+            return 100.0
+        avg_distance = mean_pair_distance(rgb)
     # Normalize to 0-100 scale (closer to 0 = more harmonious)
-    harmony_score = max(0, 100 - (avg_distance / 441) * 100)  # 441 is max RGB distance
+    harmony_score = max(0, 100 - (avg_distance / _MAX_RGB_DISTANCE) * 100)
     return harmony_score
 
 def calculate_thread_usage(stitches: List[Dict]) -> Dict[str, float]:
@@ -868,16 +1474,110 @@ def calculate_thread_usage(stitches: List[Dict]) -> Dict[str, float]:
         "stitch_count": len(stitches)
     }
 
-@app.post("/upscale")
-async def upscale(image: UploadFile = File(...), scale: int = Query(2, ge=2, le=4)):
-    # Placeholder LANCZOS upscale. Swap with Real-ESRGAN / StableSR in production.
-    data = await image.read()
-    im = Image.open(io.BytesIO(data)).convert("RGBA")
+# Upscale kernels per backend. Integer factors tolerate cheaper kernels: bicubic costs
+# about half of LANCZOS and looks the same at 2x, while LANCZOS's extra sharpness only
+# pays off at 3-4x (see _default_resample)
+RESAMPLE_METHODS = ("lanczos", "bicubic", "bilinear")
+_VIPS_KERNELS = {"lanczos": "lanczos3", "bicubic": "cubic", "bilinear": "linear"}
+_PIL_FILTERS = {"lanczos": Image.Resampling.LANCZOS, "bicubic": Image.Resampling.BICUBIC,
+                "bilinear": Image.Resampling.BILINEAR}
+if _HAS_CV2:
+    _CV2_INTERP = {"lanczos": cv2.INTER_LANCZOS4, "bicubic": cv2.INTER_CUBIC, "bilinear": cv2.INTER_LINEAR}
+
+def _default_resample(scale: int) -> str:
+    return "bicubic" if scale <= 2 else "lanczos"
+
+def _upscale_png_cv2(data: bytes, scale: int, method: str = "lanczos") -> Optional[bytes]:
+    """OpenCV upscale to a PNG in the source's channel layout; None for inputs cv2 cannot decode (e.g. GIF)."""
+    im = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+    if im is None:
+        return None
+    if im.dtype != np.uint8:
+        im = (im >> 8).astype(np.uint8) if im.dtype == np.uint16 else cv2.convertScaleAbs(im)
+    # Gray/BGR stay as decoded: no alpha plane to allocate, resize and deflate
+    h, w = im.shape[:2]
+    size, interp = (w * scale, h * scale), _CV2_INTERP[method]
+    if im.ndim == 3 and im.shape[2] in (2, 4):
+        # cv2.resize treats alpha as just another channel; interpolate premultiplied colour
+        # so fully transparent neighbours don't bleed dark fringes into the edges
+        f = im.astype(np.float32)
+        f[..., :-1] *= f[..., -1:] / 255.0
+        f = cv2.resize(f, size, interpolation=interp)
+        alpha = np.clip(f[..., -1:], 0.0, 255.0)
+        f[..., :-1] *= 255.0 / np.maximum(alpha, 1e-3)
+        f[..., -1:] = alpha
+        up = np.clip(f, 0.0, 255.0).round().astype(np.uint8)
+    else:
+        up = cv2.resize(im, size, interpolation=interp)
+    ok, buf = cv2.imencode(".png", up, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    return buf.tobytes() if ok else None
+
+def _check_upscale_size(data: bytes) -> None:
+    """Reject decompression bombs from the header alone, before any backend decodes pixels.
+
+    pyvips and cv2 have no pixel limit of their own, so PIL's MAX_IMAGE_PIXELS applies to
+    every tier.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as probe:  # lazy: reads only the header
+            w, h = probe.size
+    except Image.DecompressionBombError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    if Image.MAX_IMAGE_PIXELS and w * h > Image.MAX_IMAGE_PIXELS:
+        raise HTTPException(status_code=413, detail=f"Image too large to upscale ({w}x{h} pixels)")
+
+def upscale_png(data: bytes, scale: int, method: str = "lanczos") -> bytes:
+    """Upscale an image to a PNG with one of RESAMPLE_METHODS, keeping gray/RGB sources free
+    of an alpha channel (pyvips, then OpenCV, then PIL)."""
+    _check_upscale_size(data)
+    if _HAS_PYVIPS:
+        # SIMD, multi-threaded resampling with a tile-sized working set; pngsave itself
+        # converts non-PNG colourspaces such as CMYK
+        vi = pyvips.Image.new_from_buffer(data, "")
+        kernel = _VIPS_KERNELS[method]
+        if vi.hasalpha():
+            # Resample premultiplied colour so transparent pixels don't darken the edges
+            up = vi.premultiply().resize(scale, kernel=kernel).unpremultiply().cast(vi.format)
+        else:
+            up = vi.resize(scale, kernel=kernel)
+        return up.write_to_buffer(".png[compression=1]")
+    if _HAS_CV2:
+        png = _upscale_png_cv2(data, scale, method)
+        if png is not None:
+            return png
+    im = Image.open(io.BytesIO(data))
+    # Only palette/CMYK/16-bit etc. need converting, and only transparent ones get a 4th channel
+    if im.mode not in ("L", "LA", "RGB", "RGBA") or "transparency" in im.info:
+        if "A" in im.getbands() or "transparency" in im.info:
+            im = im.convert("RGBA")
+        else:
+            im = im.convert("L" if len(im.getbands()) == 1 and im.mode != "P" else "RGB")
     w, h = im.size
-    up = im.resize((w * scale, h * scale), Image.Resampling.LANCZOS)
+    up = im.resize((w * scale, h * scale), _PIL_FILTERS[method])
     buf = io.BytesIO()
-    up.save(buf, format="PNG")
-    return Response(buf.getvalue(), media_type="image/png")
+    # Same fast deflate level as the other backends; getvalue() hands back the buffer without copying
+    up.save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
+
+# Resize/encode release the GIL, so a dedicated pool scales with cores; the semaphore
+# keeps bursts from holding more decoded images in memory than there are workers
+_UPSCALE_WORKERS = os.cpu_count() or 1
+_UPSCALE_POOL = ThreadPoolExecutor(max_workers=_UPSCALE_WORKERS, thread_name_prefix="upscale")
+_UPSCALE_SLOTS = asyncio.Semaphore(_UPSCALE_WORKERS)
+
+@app.post("/upscale")
+async def upscale(image: UploadFile = File(...), scale: int = Query(2, ge=2, le=4),
+                  method: Optional[str] = Query(None)):
+    # Placeholder interpolating upscale. Swap with Real-ESRGAN / StableSR in production.
+    method = method or _default_resample(scale)
+    if method not in RESAMPLE_METHODS:
+        raise HTTPException(status_code=400, detail=f"method must be one of {', '.join(RESAMPLE_METHODS)}")
+    # Pull the (still compressed) upload before taking a slot, so receiving the next
+    # request overlaps the resizes already running instead of idling a worker
+    data = await image.read()
+    async with _UPSCALE_SLOTS:
+        png = await asyncio.get_running_loop().run_in_executor(_UPSCALE_POOL, upscale_png, data, scale, method)
+    return Response(png, media_type="image/png")
 
 if __name__ == "__main__":
     import uvicorn
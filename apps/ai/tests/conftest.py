@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def client():
+    """App client with startup/shutdown hooks run, as uvicorn would."""
+    with TestClient(main.app) as c:
+        yield c
@@ -0,0 +1,60 @@
+import itertools
+import math
+import re
+
+import numpy as np
+import pytest
+
+import main
+
+
+def _reference_harmony(colors):
+    rgb = [bytes.fromhex(c[1:]) for c in colors if re.fullmatch(r"#[0-9a-fA-F]{6}", c)]
+    if len(rgb) < 2:
+        return 100.0
+    dists = [math.dist(a, b) for a, b in itertools.combinations(rgb, 2)]
+    return max(0, 100 - (sum(dists) / len(dists) / 441) * 100)
+
+
+def _palette(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return [f"#{v:06x}" for v in rng.integers(0, 1 << 24, n)]
+
+
+@pytest.mark.parametrize("n", [2, 5, 7, 8, 40])
+def test_harmony_matches_pairwise_mean(n):
+    colors = _palette(n, seed=n)
+    assert main.calculate_color_harmony(colors) == pytest.approx(_reference_harmony(colors), abs=1e-9)
+
+
+def test_harmony_skips_malformed_entries():
+    colors = ["#ff0000", "red", "#12", "#zzzzzz", "#00ff00"] + ["#0000ff"] * 4
+    assert main.calculate_color_harmony(colors) == pytest.approx(_reference_harmony(colors), abs=1e-9)
+    assert main.calculate_color_harmony(["#ff0000", "nope"]) == 100.0
+
+
+def test_harmony_ignores_order_and_case():
+    colors = _palette(12, seed=3)
+    flipped = [c.upper() for c in reversed(colors)]
+    assert main.calculate_color_harmony(flipped) == pytest.approx(main.calculate_color_harmony(colors))
+
+
+@pytest.mark.parametrize("numba, scipy, workers", [
+    (True, True, 1), (False, True, 1), (False, False, 1), (True, True, 4), (False, False, 4),
+])
+def test_mean_pair_distance_backends_agree(monkeypatch, numba, scipy, workers):
+    monkeypatch.setattr(main, "_HAS_NUMBA", numba and main._HAS_NUMBA)
+    monkeypatch.setattr(main, "_HAS_SCIPY", scipy and main._HAS_SCIPY)
+    monkeypatch.setattr(main, "_PAIR_WORKERS", workers)
+    monkeypatch.setattr(main, "_PARALLEL_PAIR_ROWS", 100)
+    rgb = np.random.default_rng(1).integers(0, 256, (300, 3)).astype(np.float64)
+    i, j = np.triu_indices(len(rgb), 1)
+    expected = np.linalg.norm(rgb[i] - rgb[j], axis=1).mean()
+    assert main.mean_pair_distance(rgb) == pytest.approx(expected, rel=1e-12)
+
+
+def test_color_theme_by_hue_and_name():
+    assert main.determine_color_theme(["#ff0000", "#ffa500"]) == "warm"
+    assert main.determine_color_theme(["#0000ff", "teal green"]) == "cool"
+    assert main.determine_color_theme(["#808080"]) == "balanced"
+    assert main.determine_color_theme([]) == "neutral"
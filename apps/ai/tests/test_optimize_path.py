@@ -0,0 +1,82 @@
+import math
+import random
+
+import pytest
+
+import main
+
+
+def _reference_order(stitches):
+    """The original O(n^2) greedy loop: nearest start to the last end, first index on ties."""
+    order, remaining = [0], list(range(1, len(stitches)))
+    while remaining:
+        pts = stitches[order[-1]]["points"]
+        last = pts[-1] if pts else {"x": 0, "y": 0}
+        best, best_d = 0, float("inf")
+        for k, i in enumerate(remaining):
+            if stitches[i]["points"]:
+                p = stitches[i]["points"][0]
+                d = math.sqrt((p["x"] - last["x"]) ** 2 + (p["y"] - last["y"]) ** 2)
+                if d < best_d:
+                    best, best_d = k, d
+        order.append(remaining.pop(best))
+    return order
+
+
+def _random_stitches(rng, n, grid):
+    return [
+        {"id": i, "points": [{"x": rng.randint(0, grid), "y": rng.randint(0, grid)}
+                             for _ in range(rng.randint(0, 3))]}
+        for i in range(n)
+    ]
+
+
+@pytest.mark.parametrize("scipy", [True, False])
+def test_tour_matches_reference_including_ties(monkeypatch, scipy):
+    monkeypatch.setattr(main, "_HAS_SCIPY", scipy and main._HAS_SCIPY)
+    rng = random.Random(7)
+    for _ in range(60):
+        # a coarse integer grid makes equal-distance ties common
+        stitches = _random_stitches(rng, rng.randint(1, 80), rng.choice([3, 6, 20]))
+        got = [s["id"] for s in main.optimize_stitch_sequence(stitches, {})]
+        assert got == _reference_order(stitches)
+
+
+def test_flower_petals_keep_input_order_on_ties():
+    flower = main.generate_flower_pattern(400, 400, ["french-knot", "lazy-daisy"])
+    ids = [s["id"] for s in main.optimize_stitch_sequence(flower, {})]
+    assert ids == ["flower_center"] + [f"petal_{i}" for i in range(8)]
+
+
+def test_travel_lengths():
+    stitches = [
+        {"points": [{"x": 0, "y": 0}, {"x": 3, "y": 4}]},
+        {"points": []},
+        {"points": [{"x": 3, "y": 0}, {"x": 3, "y": 1}]},
+        {"points": [{"x": 6, "y": 8}]},
+    ]
+    batch = main.StitchBatch.from_dicts(stitches)
+    assert batch.lengths().tolist() == pytest.approx([5.0, 0.0, 1.0, 0.0])
+    # empty stitches are skipped: (3,4)->(3,0) then (3,1)->(6,8)
+    assert batch.travel_length() == pytest.approx(4.0 + math.hypot(3, 7))
+    assert batch.travel_length([0, 3, 2, 1]) == pytest.approx(5.0 + math.hypot(3, 8))
+
+
+def test_optimize_path_endpoint_stats(client):
+    stitches = [
+        {"id": "a", "points": [{"x": 0, "y": 0}, {"x": 10, "y": 0}]},
+        {"id": "far", "points": [{"x": 100, "y": 0}, {"x": 110, "y": 0}]},
+        {"id": "near", "points": [{"x": 12, "y": 0}, {"x": 20, "y": 0}]},
+    ]
+    r = client.post("/ai/optimize-path", json={"stitches": stitches, "fabricPhysics": {}})
+    assert r.status_code == 200
+    body = r.json()
+    assert [s["id"] for s in body["stitches"]] == ["a", "near", "far"]
+    stats = body["optimization_stats"]
+    assert stats["original_length"] == pytest.approx(28.0)
+    assert stats["optimized_length"] == pytest.approx(28.0)
+    assert stats["efficiency_gain"] == pytest.approx(
+        main.calculate_efficiency_gain(stitches, body["stitches"]))
+    assert stats["original_travel"] == pytest.approx(90.0 + 98.0)
+    assert stats["optimized_travel"] == pytest.approx(2.0 + 80.0)
+    assert stats["efficiency_gain_with_travel"] == pytest.approx((216.0 - 110.0) / 216.0 * 100)
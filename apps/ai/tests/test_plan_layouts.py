@@ -0,0 +1,49 @@
+import pytest
+
+import main
+
+SVG = (b'<svg xmlns="http://www.w3.org/2000/svg">'
+       b'<path d="M0 0 L100 0" stroke="#ff0000"/>'
+       b'<path d="M0 50 C 30 0 60 100 100 50" stroke="#00ff00"/></svg>')
+
+
+def _generate(client, layout, **query):
+    params = "&".join(f"{k}={v}" for k, v in {"layout": layout, **query}.items())
+    return client.post(f"/embroidery/generate?{params}", files={"svg_file": ("a.svg", SVG, "image/svg+xml")})
+
+
+def _points_from_soa(body):
+    plan = {**body, "types": [main.STITCH_TYPE_NAMES.index(t) for t in body["types"]]}
+    return main.expand_points(plan)
+
+
+@pytest.mark.parametrize("strategy", ["outline", "satin", "fill"])
+def test_svg_soa_layout_matches_points(client, strategy):
+    points = _generate(client, "points", strategy=strategy).json()
+    soa = _generate(client, "soa", strategy=strategy).json()
+    assert len(soa["xs"]) == len(soa["ys"]) == len(soa["types"]) == soa["info"]["stitch_count"]
+    assert [c["color"] for c in soa["color_changes"]] == ["#ff0000", "#00ff00"]
+    assert _points_from_soa(soa) == points["points"]
+    assert soa["info"] == points["info"]
+
+
+def test_from_points_soa_layout_matches_points(client):
+    body = {"canvas_width": 100, "canvas_height": 100, "strategy": "satin", "passes": 2,
+            "points": [{"x": 0, "y": 0}, {"x": 40, "y": 30}, {"x": 80, "y": 0}]}
+    points = client.post("/embroidery/generate_from_points", json=body).json()
+    soa = client.post("/embroidery/generate_from_points", json={**body, "layout": "soa"}).json()
+    assert _points_from_soa(soa) == points["points"]
+
+
+def test_unknown_layout_is_rejected(client):
+    assert _generate(client, "columns").status_code == 400
+
+
+@pytest.mark.skipif(not main._HAS_PYEMBROIDERY, reason="pyembroidery not installed")
+def test_dst_round_trip_keeps_color_changes(client):
+    dst = _generate(client, "soa", return_dst="true")
+    assert dst.status_code == 200
+    r = client.post("/embroidery/plan?format=dst&layout=soa",
+                    files={"machine_file": ("a.dst", dst.content, "application/octet-stream")})
+    assert r.status_code == 200
+    assert r.json()["types"].count("color_change") == 1
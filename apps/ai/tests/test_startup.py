@@ -0,0 +1,10 @@
+import main
+
+
+def test_startup_hooks_run(client):
+    # Entering the client runs _warm_kernels, so kernel signature drift fails here
+    assert client.get("/health").json() == {"ok": True}
+
+
+def test_warm_kernels_direct():
+    main._warm_kernels()
@@ -0,0 +1,37 @@
+import main
+
+
+def _from_points(client, strategy, length_px, **params):
+    body = {
+        "canvas_width": 10, "canvas_height": 10, "strategy": strategy,
+        "mm_per_px": 1.0, "stitch_len_mm": 1.0, "width_mm": 4.0,
+        "points": [{"x": 0, "y": 0}, {"x": length_px, "y": 0}],
+        **params,
+    }
+    return client.post("/embroidery/generate_from_points", json=body)
+
+
+def test_double_satin_over_budget_is_rejected(client):
+    # ~1M samples at 1 px, two rails each: double MAX_STITCHES
+    r = _from_points(client, "double_satin", main.MAX_STITCHES - 10)
+    assert r.status_code == 400
+    assert "stitch density too high" in r.json()["detail"]
+
+
+def test_satin_passes_count_against_budget(client):
+    r = _from_points(client, "satin", main.MAX_STITCHES // 4, passes=8)
+    assert r.status_code == 400
+
+
+def test_within_budget_succeeds(client):
+    r = _from_points(client, "double_satin", 1000, layout="soa")
+    assert r.status_code == 200
+    assert r.json()["info"]["stitch_count"] == 2 * 1001
+
+
+def test_svg_budget_rejected_before_sampling(client):
+    lines = "".join(f'<path d="M0 {i} L200000 {i}" stroke="#ff0000"/>' for i in range(400))
+    svg = f'<svg xmlns="http://www.w3.org/2000/svg">{lines}</svg>'.encode()
+    r = client.post("/embroidery/generate?mm_per_px=100&stitch_len_mm=0.01",
+                    files={"svg_file": ("a.svg", svg, "image/svg+xml")})
+    assert r.status_code == 400
@@ -0,0 +1,77 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import main
+
+BACKENDS = [  # (pyvips, opencv) enabled
+    pytest.param((True, True), marks=pytest.mark.skipif(not main._HAS_PYVIPS, reason="pyvips not installed")),
+    pytest.param((False, True), marks=pytest.mark.skipif(not main._HAS_CV2, reason="opencv not installed")),
+    pytest.param((False, False)),
+]
+
+
+def _png(im):
+    buf = io.BytesIO()
+    im.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _upscale(client, data, query="scale=2"):
+    return client.post(f"/upscale?{query}", files={"image": ("a.png", data, "image/png")})
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request, monkeypatch):
+    vips, cv = request.param
+    monkeypatch.setattr(main, "_HAS_PYVIPS", vips)
+    monkeypatch.setattr(main, "_HAS_CV2", cv)
+
+
+@pytest.mark.parametrize("query, size", [
+    ("scale=2", (12, 10)),
+    ("scale=3", (18, 15)),
+    ("scale=2&method=lanczos", (12, 10)),
+    ("scale=4&method=bilinear", (24, 20)),
+])
+def test_method_param(client, backend, query, size):
+    r = _upscale(client, _png(Image.new("RGB", (6, 5), (10, 200, 30))), query)
+    assert r.status_code == 200
+    out = Image.open(io.BytesIO(r.content))
+    assert out.size == size
+    assert out.getpixel((3, 3))[:3] == (10, 200, 30)
+
+
+def test_unknown_method_is_rejected(client):
+    r = _upscale(client, _png(Image.new("RGB", (4, 4))), "scale=2&method=nearest")
+    assert r.status_code == 400
+
+
+def test_default_method_follows_scale():
+    assert main._default_resample(2) == "bicubic"
+    assert main._default_resample(3) == main._default_resample(4) == "lanczos"
+
+
+@pytest.mark.parametrize("mode", ["L", "RGB", "RGBA"])
+def test_source_mode_is_kept(client, backend, mode):
+    r = _upscale(client, _png(Image.new(mode, (4, 4))))
+    assert Image.open(io.BytesIO(r.content)).mode == mode
+
+
+@pytest.mark.parametrize("method", main.RESAMPLE_METHODS)
+def test_transparent_edges_keep_their_colour(client, backend, method):
+    im = Image.new("RGBA", (16, 16), (0, 0, 0, 0))
+    im.paste((255, 255, 255, 255), (4, 4, 12, 12))
+    r = _upscale(client, _png(im), f"scale=4&method={method}")
+    out = np.asarray(Image.open(io.BytesIO(r.content)).convert("RGBA")).astype(int)
+    visible = out[out[..., 3] > 0]
+    # premultiplied resampling: no dark fringe where white meets transparent black
+    assert visible[:, :3].min() >= 254
+
+
+def test_oversized_image_is_rejected_before_decoding(client, backend, monkeypatch):
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100)
+    r = _upscale(client, _png(Image.new("L", (20, 20))))
+    assert r.status_code == 413